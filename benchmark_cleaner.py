@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+'''Benchmark of wikicleaner.clean on the pages of a dump and on a synthetic
+corpus of larger articles made by joining them. Reports articles and MB per
+second, the slowest articles and the time spent in each stage of clean, and
+compares the HTML engines, which must clean the pages identically.
+The cleaned pages of the dump can be saved as golden output (--save-golden),
+and later checked against it (--golden), so changes to the cleaner can be
+judged on correctness as well as speed.
+With --stress, dropNested and drop_spans are also compared with the way they
+used to build their result by repeated string concatenation, on generated
+pages with deeply nested templates, many templates and large tables.
+Usage: python benchmark_cleaner.py [--dump FILE] [--scale N] [--engine NAME]
+       [--slowest N] [--golden FILE | --save-golden FILE] [--stress]
+       [--sizes N ...] [--repeat N]'''
+
+import argparse
+import codecs
+import json
+import os
+import re
+import xml.sax as SAX
+from timeit import default_timer as timer
+import wikicleaner
+from benchmark_links import TextCollector, timeit
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def legacy_dropNested(text, openDelim, closeDelim):
+    '''dropNested as it was before the result was joined from a list.'''
+    openRE = re.compile(openDelim)
+    closeRE = re.compile(closeDelim)
+    # partition text in separate blocks { } { }
+    matches = []                # pairs (s, e) for each partition
+    nest = 0                    # nesting level
+    start = openRE.search(text, 0)
+    if not start:
+        return text
+    end = closeRE.search(text, start.end())
+    next = start
+    while end:
+        next = openRE.search(text, next.end())
+        if not next:            # termination
+            while nest:         # close all pending
+                nest -=1
+                end0 = closeRE.search(text, end.end())
+                if end0:
+                    end = end0
+                else:
+                    break
+            matches.append((start.start(), end.end()))
+            break
+        while end.end() < next.start():
+            # { } {
+            if nest:
+                nest -= 1
+                # try closing more
+                last = end.end()
+                end = closeRE.search(text, end.end())
+                if not end:     # unbalanced
+                    if matches:
+                        span = (matches[0][0], last)
+                    else:
+                        span = (start.start(), last)
+                    matches = [span]
+                    break
+            else:
+                matches.append((start.start(), end.end()))
+                # advance start, find next close
+                start = next
+                end = closeRE.search(text, next.end())
+                break           # { }
+        if next != start:
+            # { { }
+            nest += 1
+    # collect text outside partitions
+    res = ''
+    start = 0
+    for s, e in  matches:
+        res += text[start:s]
+        start = e
+    res += text[start:]
+    return res
+
+def legacy_drop_spans(matches, text):
+    '''drop_spans as it was before the result was joined from a list.'''
+    matches.sort()
+    res = ''
+    start = 0
+    for s, e in  matches:
+        res += text[start:s]
+        start = e
+    res += text[start:]
+    return res
+
+def legacy_clean(text):
+    '''wikicleaner.clean using the legacy versions of the helpers.'''
+    current = wikicleaner.dropNested, wikicleaner.drop_spans
+    wikicleaner.dropNested = legacy_dropNested
+    wikicleaner.drop_spans = legacy_drop_spans
+    try:
+        return wikicleaner.clean(text)
+    finally:
+        wikicleaner.dropNested, wikicleaner.drop_spans = current
+
+#Generated pages, each a function of a size parameter
+def deep_templates(n):
+    '''A template nested n levels deep, between some text.'''
+    return (u'intro text ' + u'{{cite|a=' * n + u'core' + u'}} more' * n +
+            u' outro text')
+
+def many_templates(n):
+    '''n templates with a little text between them, some nested.'''
+    return u''.join(u'word{0} {{{{infobox|x={{{{flag|{0}}}}}}}}} and text '
+                    .format(i) for i in xrange(n))
+
+def large_tables(n):
+    '''Tables with n rows in total, between paragraphs of text.'''
+    row = u'|-\n| cell || {{sort|1}} || [[link]] || more cells\n'
+    table = u'{|class="wikitable"\n' + row*100 + u'|}\n'
+    return (u'some paragraph text.\n' + table) * max(n//100, 1)
+
+def many_tags(n):
+    '''Text with n formatting tags and comments, for drop_spans.'''
+    return u'<b>bold</b> <!-- c --> <sub>x</sub> plain ' * n
+
+stress_cases = [('deep templates', deep_templates),
+                ('many templates', many_templates),
+                ('large tables', large_tables),
+                ('many tags', many_tags)]
+
+def dump_articles(filename):
+    '''Returns a list of (title, lower case text) of the pages in a dump.'''
+    collector = TextCollector()
+    SAX.parse(filename, collector)
+    return zip(collector.titles, collector.pages)
+
+def scaled_articles(articles, factor):
+    '''Synthetic corpus with an article for each page of the dump, made of
+    it and the factor-1 pages following it, so articles are factor times
+    larger on average.'''
+    texts = [text for title, text in articles]
+    return [('synthetic %d' % i,
+             u'\n'.join(texts[(i+k) % len(texts)] for k in xrange(factor)))
+            for i in xrange(len(texts))]
+
+def megabytes(text):
+    return len(text.encode('utf-8'))/2.0**20
+
+def time_stages(articles, engine, repeat):
+    '''Times the cleaning of each article, stage by stage. Returns the best
+    time of each article, and the total time of each stage in the best run.'''
+    best = [float('inf')]*len(articles)
+    stage_times = None
+    for _ in xrange(repeat):
+        run = {}
+        for i, (title, text) in enumerate(articles):
+            start = previous = timer()
+            for stage, _ in wikicleaner.clean_stages(text, engine):
+                now = timer()
+                run[stage] = run.get(stage, 0.0) + now - previous
+                previous = now
+            best[i] = min(best[i], previous - start)
+        if stage_times is None or sum(run.values()) < sum(stage_times.values()):
+            stage_times = run
+    return best, stage_times
+
+def report(name, articles, engine, repeat, slowest):
+    '''Prints the speed of clean on a corpus, its slowest articles and the
+    time spent in each stage.'''
+    times, stage_times = time_stages(articles, engine, repeat)
+    sizes = [megabytes(text) for title, text in articles]
+    elapsed = sum(times)
+    print "%s: %d articles, %.2f MB, %.3f s - %.0f articles/s, %.2f MB/s" % (
+        name, len(articles), sum(sizes), elapsed, len(articles)/elapsed,
+        sum(sizes)/elapsed)
+    
+    print "  %-10s %10s %s" % ('ms', 'KB', 'slowest articles')
+    ranked = sorted(xrange(len(articles)), key = lambda i: -times[i])
+    for i in ranked[:slowest]:
+        print "  %-10.2f %10.1f %s" % (1000*times[i], 1024*sizes[i],
+                                       articles[i][0].encode('utf-8'))
+    
+    print "  %-12s %10s %8s" % ('stage', 'seconds', 'share')
+    total = sum(stage_times.values())
+    for stage, _ in wikicleaner.clean_stages(u'', engine):
+        print "  %-12s %10.3f %7.1f%%" % (stage, stage_times[stage],
+                                          100*stage_times[stage]/total)
+
+def save_golden(articles, engine, filename):
+    '''Saves the cleaned text of each article, by title.'''
+    golden = {title: wikicleaner.clean(text, engine)
+              for title, text in articles}
+    with codecs.open(filename, 'w', encoding = 'utf-8') as f:
+        json.dump(golden, f, indent = 1, sort_keys = True,
+                  ensure_ascii = False)
+    print "Saved golden output of %d articles to %s" % (len(golden), filename)
+
+def check_golden(articles, engine, filename, shown = 10):
+    '''Compares the cleaned articles with golden output saved earlier and
+    prints those that differ, with the position of the first difference.'''
+    with codecs.open(filename, 'r', encoding = 'utf-8') as f:
+        golden = json.load(f)
+    differing = []
+    missing = 0
+    for title, text in articles:
+        if title not in golden:
+            missing += 1
+            continue
+        expected, result = golden[title], wikicleaner.clean(text, engine)
+        if result != expected:
+            pos = next((i for i, (a, b) in enumerate(zip(expected, result))
+                        if a != b), min(len(expected), len(result)))
+            differing.append((title, pos, expected, result))
+    print "Golden output %s: %d of %d articles differ, %d not in it" % (
+        filename, len(differing), len(articles), missing)
+    for title, pos, expected, result in differing[:shown]:
+        print "  %s at char %d:" % (title.encode('utf-8'), pos)
+        print "    expected %r" % expected[max(pos-20, 0):pos+40]
+        print "    got      %r" % result[max(pos-20, 0):pos+40]
+
+def compare_engines(pages, repeat):
+    '''Times clean with each HTML engine and checks that they agree.'''
+    reference = [wikicleaner.clean(page, 'patterns') for page in pages]
+    print "%-10s %12s %10s %8s" % ('engine', 'articles/s', 'seconds',
+                                   'speedup')
+    base = None
+    for engine in sorted(wikicleaner.html_engines):
+        if [wikicleaner.clean(page, engine) for page in pages] != reference:
+            print "ERROR: engine %s cleans differently!" % engine
+        elapsed = timeit(lambda page: wikicleaner.clean(page, engine), pages,
+                         repeat)
+        base = base or elapsed
+        print "%-10s %12.0f %10.3f %7.1fx" % (engine, len(pages)/elapsed,
+                                               elapsed, base/elapsed)
+
+def main():
+    argparser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+    argparser.add_argument('--dump', default = os.path.join(here,
+                                                            'nanowiki.xml'),
+                           help = "Dump whose pages are cleaned")
+    argparser.add_argument('--scale', type = int, default = 10,
+                           help = "Number of pages joined into each article "
+                           "of the synthetic corpus, 0 to skip it")
+    argparser.add_argument('--engine', default = 'scan',
+                           choices = sorted(wikicleaner.html_engines),
+                           help = "HTML engine to time and check")
+    argparser.add_argument('--slowest', type = int, default = 10,
+                           help = "Number of slowest articles to show")
+    golden = argparser.add_mutually_exclusive_group()
+    golden.add_argument('--golden', help = "Check the cleaned pages of the "
+                        "dump against golden output saved in this file")
+    golden.add_argument('--save-golden', help = "Save the cleaned pages of "
+                        "the dump to this file as golden output")
+    argparser.add_argument('--stress', action = 'store_true',
+                           help = "Compare dropNested and drop_spans with "
+                           "their legacy versions on generated pages")
+    argparser.add_argument('--sizes', type = int, nargs = '+',
+                           default = [1000, 4000, 16000],
+                           help = "Size parameters of the generated pages")
+    argparser.add_argument('--repeat', type = int, default = 3)
+    args = argparser.parse_args()
+
+    #Pages are lower cased like in xml_parse.py
+    articles = dump_articles(args.dump)
+    if args.save_golden:
+        save_golden(articles, args.engine, args.save_golden)
+    elif args.golden:
+        check_golden(articles, args.engine, args.golden)
+    
+    report(args.dump, articles, args.engine, args.repeat, args.slowest)
+    if args.scale > 1:
+        report("synthetic x%d" % args.scale,
+               scaled_articles(articles, args.scale), args.engine,
+               args.repeat, args.slowest)
+    pages = [text for title, text in articles]
+    compare_engines(pages, args.repeat)
+    
+    if not args.stress:
+        return
+    #Equivalence on real pages
+    differences = sum(1 for page in pages
+                      if wikicleaner.clean(page) != legacy_clean(page))
+    print "%s pages in %s, %s cleaned differently than before" % (
+        len(pages), args.dump, differences)
+
+    print "%-16s %8s %8s %12s %12s %8s" % ('case', 'size', 'chars',
+                                           'legacy (s)', 'new (s)',
+                                           'speedup')
+    for name, make_page in stress_cases:
+        for size in args.sizes:
+            page = [make_page(size)]
+            if wikicleaner.clean(page[0]) != legacy_clean(page[0]):
+                print "ERROR: %s of size %s is cleaned differently!" % (
+                    name, size)
+            legacy_time = timeit(legacy_clean, page, args.repeat)
+            new_time = timeit(wikicleaner.clean, page, args.repeat)
+            print "%-16s %8s %8s %12.3f %12.3f %7.1fx" % (name, size,
+                        len(page[0]), legacy_time, new_time,
+                        legacy_time/max(new_time, 1e-6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+'''Microbenchmark of link extraction. Compares wikilinks.LinkExtractor with
+the way xml_parse.py used to extract links, and checks that both find the
+same links.
+Pages are read from a dump if one is given, otherwise synthetic link-heavy
+pages are generated.
+Usage: python benchmark_links.py [--dump FILE] [--pages N] [--repeat N]'''
+
+import argparse
+import random
+import re
+import time
+import xml.sax as SAX
+import wikicleaner
+import wikilinks
+
+def legacy_canonize_title(title):
+    '''canonize_title as it was before wikilinks.py.'''
+    title = title.strip(' _')
+    title = re.compile(r'[\s_]+').sub(' ', title)
+    title = re.sub('[?/\\\*\"\']','',title)
+    return title.title()
+
+def legacy_extract(text):
+    '''Link extraction as it was done in WikiHandler.process.'''
+    result = []
+    link_regexp = re.compile(r'\[\[(.*?)\]')
+    links = re.findall(link_regexp, text)
+    for link in links:
+        if any([ns+':' in link for ns in wikicleaner.namespaces]):
+            continue
+        link = link.replace(':', '')
+        if not link:
+            continue
+        raw = re.match(r'([^\|\#]*)', link).group(0)
+        result.append(legacy_canonize_title(raw))
+    return result
+
+def synthetic_pages(n_pages, links_per_page = 500, n_titles = 5000):
+    '''Generates link-heavy pages. Titles follow a skewed distribution, like
+    real links, and some links have display text, sections or namespaces.'''
+    rng = random.Random(42)
+    words = ['alpha', 'beta', 'gamma', 'delta', 'ship', 'war', 'city',
+             'river', 'theory', 'of', 'the', 'history', 'united', 'states']
+    titles = [' '.join(rng.sample(words, rng.randint(1, 4)))
+              for _ in xrange(n_titles)]
+    namespaces = sorted(wikicleaner.namespaces)
+    pages = []
+    for _ in xrange(n_pages):
+        parts = []
+        for _ in xrange(links_per_page):
+            title = titles[min(int(rng.expovariate(1.0/300)), n_titles-1)]
+            kind = rng.random()
+            if kind < 0.1:
+                link = '[[%s:%s.png|thumb|%s]]' % (rng.choice(namespaces),
+                                                   title, title)
+            elif kind < 0.3:
+                link = '[[%s|%s]]' % (title, rng.choice(words))
+            elif kind < 0.4:
+                link = '[[%s#%s]]' % (title, rng.choice(words))
+            else:
+                link = '[[%s]]' % title
+            parts.append(link + ' some text in between, ')
+        pages.append(''.join(parts))
+    return pages
+
+class TextCollector(SAX.ContentHandler):
+    '''Collects the lower case text and the title of each page in a dump.'''
+    def __init__(self):
+        SAX.ContentHandler.__init__(self)
+        self.current = None
+        self.buffer = []
+        self.pages = []
+        self.titles = []
+
+    def startElement(self, tag, attrs):
+        self.current = tag
+
+    def endElement(self, name):
+        if name == 'text':
+            self.pages.append(''.join(self.buffer).lower())
+        elif name == 'title':
+            self.titles.append(''.join(self.buffer))
+        self.buffer = []
+        self.current = None
+
+    def characters(self, content):
+        if self.current in ('text', 'title'):
+            self.buffer.append(content)
+
+def dump_pages(filename):
+    collector = TextCollector()
+    SAX.parse(filename, collector)
+    return collector.pages
+
+def timeit(extract, pages, repeat):
+    '''Returns the best time of repeat runs over all pages.'''
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        for page in pages:
+            extract(page)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    argparser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+    argparser.add_argument('--dump', help = "Take pages from this XML dump")
+    argparser.add_argument('--pages', type = int, default = 200,
+                           help = "Number of synthetic pages")
+    argparser.add_argument('--repeat', type = int, default = 3)
+    argparser.add_argument('--cache-size', type = int, default = 10**5)
+    args = argparser.parse_args()
+
+    if args.dump:
+        pages = dump_pages(args.dump)
+    else:
+        pages = synthetic_pages(args.pages)
+
+    extractor = wikilinks.LinkExtractor(cache_size = args.cache_size)
+    expected = [legacy_extract(page) for page in pages]
+    found = [extractor.extract(page) for page in pages]
+    n_links = sum(len(page) for page in found)
+    print "%s pages, %s links found" % (len(pages), n_links)
+    if found != expected:
+        print "ERROR: LinkExtractor finds different links than before!"
+
+    legacy_time = timeit(legacy_extract, pages, args.repeat)
+    extractor_time = timeit(extractor.extract, pages, args.repeat)
+    print "%-14s %14s %10s" % ('', 'links/s', 'seconds')
+    print "%-14s %14.0f %10.3f" % ('legacy', n_links/legacy_time, legacy_time)
+    print "%-14s %14.0f %10.3f" % ('LinkExtractor', n_links/extractor_time,
+                                   extractor_time)
+    print "Speedup: %.1fx" % (legacy_time/extractor_time)
+    hits, misses, size = extractor.canonize.cache_info()
+    print "Title cache: %s hits, %s misses, %s entries" % (hits, misses, size)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+'''Benchmarks the XML parse engines in xml_parse.py against each other.
+A test dump is made by repeating the pages of a small dump (nanowiki.xml by
+default) under unique titles. Each engine parses it in a separate process
+so its peak memory usage can be measured, and the outputs are compared to
+make sure the engines agree.
+With --processes, the first engine also parses the dump with a
+ParallelWikiHandler, whose output files must be identical to those of the
+serial parse, including which pages are listed in each page hash file.
+Usage: python benchmark_parse.py [--dump FILE] [--copies N] [--mode MODE]
+       [--processes N]'''
+
+import argparse
+import glob
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None  #Not available on Windows - skip memory measurements
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def scale_dump(source, copies, destination):
+    '''Writes a dump containing the pages of source repeated copies times,
+    with a copy number appended to each title. Returns the number of pages.'''
+    with open(source, 'rb') as f:
+        data = f.read()
+    start = data.index('<page>')
+    end = data.rindex('</page>') + len('</page>')
+    pages = re.findall(r'<page>.*?</page>', data[start:end], re.DOTALL)
+
+    title = re.compile(r'<title>(.*?)</title>', re.DOTALL)
+    with open(destination, 'wb') as f:
+        f.write(data[:start])
+        for n in xrange(copies):
+            for page in pages:
+                f.write(title.sub(lambda m: '<title>%s %d</title>'
+                                  % (m.group(1), n), page, count = 1))
+                f.write('\n')
+        f.write(data[end:])
+    return copies*len(pages)
+
+def run_engine(engine, dump, outdir, resultfile, mode, processes = '1'):
+    '''Parses dump with the given engine, writing output files to outdir.
+    Timing and peak memory usage are saved to resultfile. In parse mode pages
+    are collected but not processed, to time the XML layer on its own. In
+    full mode pages are processed by a pool of worker processes if
+    processes is more than 1.'''
+    import xml_parse
+    
+    class ParseOnlyHandler(xml_parse.WikiHandler):
+        '''Handler which skips cleaning, but stores the raw page data.'''
+        def process(self):
+            self.output_buffer[self.title] = {
+                'text' : ''.join(self.input_buffer),
+                'redirect' : self.redirect}
+            self.article_counter += 1
+            if self.article_counter%1000 == 0:
+                self.writeout()
+            self.flush_input_buffer()
+    
+    filename_maker = xml_parse.filename_generator(outdir)
+    if int(processes) > 1:
+        handler = xml_parse.ParallelWikiHandler(int(processes),
+                                                filename_maker = filename_maker)
+    else:
+        handlers = {'full' : xml_parse.WikiHandler,
+                    'parse' : ParseOnlyHandler}
+        handler = handlers[mode](filename_maker)
+    parser = xml_parse.make_parser(engine)
+    parser.setContentHandler(handler)
+
+    start = time.time()
+    parser.parse(dump)
+    elapsed = time.time() - start
+
+    #Peak resident set size. Linux reports kB, OS X bytes.
+    peak = None
+    if resource:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            peak //= 1024
+    with open(resultfile, 'w') as f:
+        json.dump({'seconds' : elapsed, 'peak_kb' : peak}, f)
+
+def read_output(outdir):
+    '''Reads the files written by a parse into comparable objects. Besides
+    the combined content, words and links, the titles of the articles and of
+    the page hashes in each output file are returned, as generate_indices.py
+    relies on the pages of a content file being listed along with it.'''
+    import shared
+    from shared import extensions
+    content, words, links = {}, set([]), {}
+    files = []
+    for filename in sorted(glob.glob(os.path.join(outdir,
+                                                  '*'+extensions['content']))):
+        with open(filename, 'r') as f:
+            articles = shared.load(f)
+        content.update(articles)
+        base = filename[:-len(extensions['content'])]
+        with open(base+extensions['pages'], 'rb') as f:
+            pages = shared.load_pages(f)
+        files.append((os.path.basename(base), sorted(articles),
+                      sorted(pages)))
+    for filename in glob.glob(os.path.join(outdir, '*'+extensions['words'])):
+        with open(filename, 'rb') as f:
+            words.update(shared.load_words(f))
+    for filename in glob.glob(os.path.join(outdir, '*'+extensions['links'])):
+        with open(filename, 'rb') as f:
+            for target, sources in shared.iter_links(f):
+                links.setdefault(target, set([])).update(sources)
+    return content, words, links, files
+
+def main():
+    argparser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+    argparser.add_argument('--dump', default = os.path.join(here,
+                                                            'nanowiki.xml'),
+                           help = "Dump whose pages are repeated")
+    argparser.add_argument('--copies', type = int, default = 25000,
+                           help = "Number of times to repeat the pages")
+    argparser.add_argument('--engines', nargs = '+',
+                           default = ['sax', 'expat'])
+    argparser.add_argument('--mode', choices = ['parse', 'full'],
+                           default = 'parse', help = "Time only the XML "
+                           "parsing, or also the cleaning of each page")
+    argparser.add_argument('--processes', type = int, default = 1,
+                           help = "Also parse with this many worker "
+                           "processes and compare with the serial output "
+                           "(implies --mode full)")
+    #Used internally to run a single engine in a subprocess
+    argparser.add_argument('--run', nargs = 6, metavar = ('ENGINE', 'DUMP',
+                                            'OUTDIR', 'RESULT', 'MODE',
+                                            'PROCESSES'),
+                           help = argparse.SUPPRESS)
+    args = argparser.parse_args()
+    if args.processes > 1:
+        args.mode = 'full'
+
+    if args.run:
+        run_engine(*args.run)
+        return None
+
+    workdir = tempfile.mkdtemp()
+    try:
+        dump = os.path.join(workdir, 'scaled.xml')
+        n_pages = scale_dump(args.dump, args.copies, dump)
+        print "Scaled %s to %s pages (%.1f MB), mode: %s" % (args.dump,
+                    n_pages, os.path.getsize(dump)/float(2**20), args.mode)
+
+        results = {}
+        outputs = {}
+        runs = [(engine, engine, 1) for engine in args.engines]
+        if args.processes > 1:
+            runs.append(('%s x%d' % (args.engines[0], args.processes),
+                         args.engines[0], args.processes))
+        for name, engine, processes in runs:
+            outdir = os.path.join(workdir, name.replace(' ', '')) + os.sep
+            os.makedirs(outdir)
+            resultfile = os.path.join(workdir, name.replace(' ', '')+'.json')
+            #Run from the work dir so log and temp files end up there
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call([sys.executable,
+                                       os.path.abspath(__file__), '--run',
+                                       engine, dump, outdir, resultfile,
+                                       args.mode, str(processes)],
+                                      cwd = workdir, stdout = devnull)
+            with open(resultfile, 'r') as f:
+                results[name] = json.load(f)
+            outputs[name] = read_output(outdir)
+
+        print "%-10s %12s %10s %14s" % ('engine', 'pages/s', 'seconds',
+                                        'peak RSS (MB)')
+        for name, engine, processes in runs:
+            result = results[name]
+            peak = result['peak_kb']
+            peak = '-' if peak is None else '%.1f' % (peak/1024.0)
+            print "%-10s %12.0f %10.2f %14s" % (name,
+                                    n_pages/result['seconds'],
+                                    result['seconds'], peak)
+
+        reference = args.engines[0]
+        for name, engine, processes in runs[1:]:
+            same = outputs[name] == outputs[reference]
+            print "Output of %s %s that of %s" % (name,
+                            'is identical to' if same else 'DIFFERS from',
+                            reference)
+            #Tell which files differ, as the combined output may still agree
+            for ours, theirs in zip(outputs[name][3], outputs[reference][3]):
+                if ours != theirs:
+                    print "  %s: %d articles and %d page hashes, %d and %d " \
+                          "in %s" % (ours[0], len(ours[1]), len(ours[2]),
+                                     len(theirs[1]), len(theirs[2]),
+                                     reference)
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
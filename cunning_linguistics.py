@@ -146,12 +146,10 @@ class SemanticAnalyser(object):
     text fragments. It can compute semantic (pseudo) distance and similarity,
     as well'''
     def __init__(self, matrix_filename = 'matrix.mtx'):        
-        #Hashes for word and concept indices
-        with open(matrix_dir+'word2index.ind', 'r') as f:
-            self.word2index = shared.load(f)
-        with open(matrix_dir+'concept2index.ind', 'r') as f:
-            self.concept2index = shared.load(f)
-        self.index2concept = {i : c for c, i in self.concept2index.iteritems()}
+        #Maps of word and concept indices. These are memory mapped, so
+        #concepts are also looked up by index in concept2index
+        self.word2index = shared.load_index(matrix_dir+'word2index.ind')
+        self.concept2index = shared.load_index(matrix_dir+'concept2index.ind')
         
         #Count number of words and concepts
         self.n_words = len(self.word2index)
@@ -207,7 +205,7 @@ class SemanticAnalyser(object):
         top_n = vec.data.argsort()[:len(vec.data)-1-display_concepts:-1]
         
         #List top scoring concepts and their TD-IDF
-        concepts = [self.index2concept[vec.indices[i]] for i in top_n]
+        concepts = [self.concept2index.string(vec.indices[i]) for i in top_n]
         return concepts
 #        scores = [vec.data[i] for i in top_n]
 #        #Return as dict {concept : score}
@@ -1,14 +1,39 @@
 # -*- coding: utf-8 -*-
 '''This finishes preproccessing of the output from the XML parser.
 This script reads in link data and removes from the content files those 
-concepts that have too few incoming links. Information on incoming links
-is saved to each content file.
-Finally, index maps for words and approved concepts are generated and saved.'''
+concepts that have too few incoming links. Links to redirect pages are
+counted as links to the article they redirect to. Information on incoming
+links is saved to each content file.
+Links are joined with the articles by sorting: (content file, target,
+source) tuples are written to sorted runs, which are merged into a single
+stream in the order of the content files, so each of those is only read and
+written once. The number of pages linking to each article is counted in the
+merge, and the links to concepts are written to disk as pairs of page
+numbers, from which the sparse graph of the links between concepts is built
+for linkgraph.py.
+Finally, index maps for words and approved concepts are generated and saved.
+Words are indexed in sorted order, unless by frequency. Groups of word lists
+are combined and split into ranges of the vocabulary, each of which is indexed
+and saved separately, possibly by several processes (see merge_processes in
+shared.py), so the whole vocabulary is never held in memory.
+Words used in too few or too many articles can be left out, and words can be
+indexed by how many articles use them (see min_df in shared.py).
+When xml_parse.py updated a previous build (--incremental), words and concepts
+keep their indices from then where possible, and the changes needed to the
+existing matrix are saved for matrix_builder.py.'''
 
 from __future__ import division
 import glob
 import gc
+import heapq
+import itertools
+import bisect
+import multiprocessing
+from collections import Counter
+import numpy as np
 import shared
+import linkgraph
+import wikilinks
 import os
 import sys
 
@@ -18,13 +43,193 @@ log = shared.logmaker(logfile)
 #Import shared parameters
 from shared import extensions, temp_dir, min_links_in, matrix_dir
 
-def listchopper(l):
-    '''Generator to chop lists into chunks of a predefined length'''
-    n = shared.link_chunk_size 
-    ind = 0
-    while ind < len(l):
-        yield l[ind:ind+n]
-        ind += n
+def write_run(links, filename):
+    '''Writes (file number, target page, source page, source) tuples of
+    links to a run file, sorted and without duplicates. Each line holds a
+    link, its fields separated by NUL characters, which can't occur in
+    titles.'''
+    with open(filename, 'wb') as f:
+        for link in sorted(set(links)):
+            f.write(('%d\x00%d\x00%d\x00%s\n' % link).encode('utf8'))
+
+def read_run(filename):
+    '''Generates the links of a run file in order.'''
+    with open(filename, 'rb') as f:
+        for line in f:
+            n, target, source_page, source = (line.decode('utf8')[:-1]
+                                               .split(u'\x00'))
+            yield int(n), int(target), int(source_page), source
+
+link_extractor = wikilinks.LinkExtractor(cache_size = shared.link_cache_size)
+
+def link_title(title):
+    '''Returns a page title in the form links to it are stored in, by
+    xml_parse.py, so they can be matched with the page.'''
+    return link_extractor.canonical(title) or title
+
+def resolve_redirects(redirects):
+    '''Makes each redirect point directly to its final target by following
+    chains of redirects. Redirects that end up in a loop are dropped.'''
+    resolved = {}
+    for source in redirects:
+        #Follow the chain until a resolved title or a non-redirect is met
+        path = []
+        visited = set([])
+        title = source
+        while (title in redirects and title not in resolved
+               and title not in visited):
+            path.append(title)
+            visited.add(title)
+            title = redirects[title]
+        if title in resolved:
+            final = resolved[title]
+        elif title in visited:
+            final = None  #Loop
+        else:
+            final = title
+        for title in path:
+            resolved[title] = final
+    return {s: t for s, t in resolved.iteritems() if t is not None}
+
+def merge_words(filenames, use_df, decode = True):
+    '''Combines the words of word files. Returns a set of the words, or if
+    use_df a Counter with the number of articles using each of them. Words
+    are UTF-8 encoded unless decode.'''
+    words = Counter() if use_df else set([])
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            if use_df:
+                file_words, file_df = shared.load_word_df(f, decode)
+                for word, n in itertools.izip(file_words, file_df.tolist()):
+                    words[word] += n
+            else:
+                words.update(shared.load_words(f, decode))
+    return words
+
+def word_part_name(group, part):
+    '''Name of the part file of a group of word files and a slice.'''
+    return temp_dir + '%d-%d' % (group, part) + extensions['word_parts']
+
+def split_words(job):
+    '''Combines the words of a group of word files and splits them into
+    slices of the vocabulary, each ranging up to the next boundary. The
+    words of each slice, with their number of articles if use_df, are saved
+    to a part file. job is (filenames, group number, boundaries, use_df).
+    Words are kept UTF-8 encoded, as they're only compared.'''
+    filenames, group, boundaries, use_df = job
+    words = merge_words(filenames, use_df, decode = False)
+    ordered = sorted(words)
+    start = 0
+    for part in xrange(len(boundaries)+1):
+        if part < len(boundaries):
+            end = bisect.bisect_left(ordered, boundaries[part], start)
+        else:
+            end = len(ordered)
+        with open(word_part_name(group, part), 'wb') as f:
+            shared.write_strings(ordered[start:end], f, encoded = True)
+            if use_df:
+                shared.write_array([words[word]
+                                    for word in ordered[start:end]], f)
+        start = end
+
+def index_slice(job):
+    '''Combines the part files of a slice of the vocabulary and leaves out
+    words used in too few or too many articles. The words kept are saved,
+    concatenated, as the strings of an index file, followed by those left
+    out and their number of articles, as in a word file. job is (slice
+    number, number of groups, use_df, max_df). Returns the lengths of the
+    words kept and the number of words in the slice.'''
+    part, groups, use_df, max_df = job
+    words = Counter() if use_df else set([])
+    for group in xrange(groups):
+        filename = word_part_name(group, part)
+        with open(filename, 'rb') as f:
+            part_words = shared.read_strings(f, decode = False)
+            if use_df:
+                part_df = shared.read_array(f).tolist()
+                for word, n in itertools.izip(part_words, part_df):
+                    words[word] += n
+            else:
+                words.update(part_words)
+        os.remove(filename)
+    if use_df:
+        kept = sorted(word for word, n in words.iteritems()
+                      if shared.min_df <= n <= max_df)
+        pruned = sorted(word for word, n in words.iteritems()
+                        if not shared.min_df <= n <= max_df)
+    else:
+        kept, pruned = sorted(words), []
+    with open(temp_dir + str(part)+extensions['word_slices'], 'wb') as f:
+        f.write(''.join(kept))
+        shared.write_strings(pruned, f, encoded = True)
+        shared.write_array([words[word] for word in pruned], f)
+    return np.array([len(word) for word in kept], dtype = '<u8'), len(words)
+
+def index_words(wordfiles, use_df, max_df):
+    '''Indexes the words of the word files in sorted order, and saves the
+    index and the words left out, without holding the vocabulary in memory.
+    Groups of files are combined by a process each, and split into slices of
+    the vocabulary, which are then combined and saved by a process each.
+    Finally, the saved slices are joined.'''
+    parts = max(min(shared.merge_processes, len(wordfiles)), 1)
+    #Slices should have about as many words each. Most of the vocabulary is
+    #rare words, so they're sampled from words in just one of a few files.
+    seen = Counter()
+    for filename in wordfiles[::max(len(wordfiles)//10, 1)][:10]:
+        with open(filename, 'rb') as f:
+            seen.update(shared.load_words(f, decode = False))
+    sample = sorted([word for word, n in seen.iteritems() if n == 1])
+    del seen
+    boundaries = sorted(set([sample[len(sample)*k//parts]
+                             for k in xrange(1, parts) if sample]))
+    del sample
+    groups = [(wordfiles[k::parts], k, boundaries, use_df)
+              for k in xrange(parts)]
+    slices = [(k, parts, use_df, max_df) for k in xrange(len(boundaries)+1)]
+    if parts > 1:
+        pool = multiprocessing.Pool(parts)
+        pool.map(split_words, groups)
+        results = pool.map(index_slice, slices)
+        pool.close()
+        pool.join()
+    else:
+        map(split_words, groups)
+        results = map(index_slice, slices)
+    
+    sources = [open(temp_dir + str(k)+extensions['word_slices'], 'rb')
+               for k in xrange(len(slices))]
+    with open(matrix_dir+'word2index.ind', 'wb') as f:
+        shared.dump_index_parts([(lengths, source) for (lengths, n), source
+                                 in zip(results, sources)], f)
+    #Each source is now at the words left out of its slice
+    with open(shared.pruned_file, 'wb') as f:
+        shared.dump_word_parts(sources, f)
+    for source in sources:
+        source.close()
+        os.remove(source.name)
+    kept = sum(len(lengths) for lengths, n in results)
+    log("Merged the words of %d files in %d slices" % (len(wordfiles),
+                                                        len(slices)))
+    if use_df:
+        log("Kept %d of %d words" % (kept, sum(n for lengths, n in results)))
+
+def update_indices(old_indices, keys, sort_key = None):
+    '''Assigns the indices 0...len(keys)-1 to the set keys, keeping those in
+    old_indices where possible, so an existing matrix only needs a few
+    changes. Keys whose index is out of range in the new matrix are moved
+    into the gaps left by keys no longer used, and remaining gaps are given
+    to new keys, in the order given by sort_key. Returns the new indices and
+    {old index : new index} for the keys that were moved.'''
+    n = len(keys)
+    indices = {k: i for k, i in old_indices.iteritems() if k in keys}
+    taken = set(i for i in indices.itervalues() if i < n)
+    gaps = (i for i in xrange(n) if i not in taken)
+    moved = {}
+    for i, k in sorted((i, k) for k, i in indices.iteritems() if i >= n):
+        indices[k] = moved[i] = next(gaps)
+    for k in sorted((k for k in keys if k not in indices), key = sort_key):
+        indices[k] = next(gaps)
+    return indices, moved
 
 def main():    
     #Import shared parameters and verify output dir exists
@@ -35,90 +240,157 @@ def main():
 #     Read in link data and update content files accordingly
 #==============================================================================
 
-    #Get list of files containing link info and chop it up
+    #Map redirect titles to the articles they point to
+    redirects = {}
+    for filename in glob.glob(temp_dir + '*'+extensions['redirects']):
+        with open(filename, 'rb') as f:
+            redirects.update(shared.load_redirects(f))
+    redirects = resolve_redirects(redirects)
+    log("Read %d redirects" % len(redirects))
+
+    #Number the content files and the pages in them, from the page hashes
+    #written along with them. Pages are known by their titles in the form
+    #links take, as that's all a link has to go by.
+    contentfiles = sorted(glob.glob(temp_dir + '*'+extensions['content']))
+    page_ids = {}  #{link title : page number}
+    file_starts = []  #Number of the first page of each file
+    duplicates = {}  #{page : [file numbers]} for pages in several files
+    
+    def page_file(page):
+        '''Number of the (first) content file holding a page.'''
+        return bisect.bisect_right(file_starts, page) - 1
+    
+    for n, filename in enumerate(contentfiles):
+        file_starts.append(len(page_ids))
+        base = filename[:-len(extensions['content'])]
+        with open(base+extensions['pages'], 'rb') as f:
+            for title in shared.load_pages(f):
+                title = link_title(title)
+                if title in page_ids:
+                    page = page_ids[title]
+                    duplicates.setdefault(page, [page_file(page)]).append(n)
+                else:
+                    page_ids[title] = len(page_ids)
+    
+    #Write links to sorted runs of (file number, target page, source page,
+    #source)
     linkfiles = glob.glob(temp_dir + '*'+extensions['links'])
-    linkchunks = listchopper(linkfiles)
+    runs = []
+    links = []
     
-    linkfiles_read = 0
-    for linkchunk in linkchunks:
-        #Hash mapping each article to a set of articles linking to it
-        linkhash = {}
-        
-        for filename in linkchunk:
-            with open(filename, 'r') as f:
-                newstuff = shared.load(f)
-            #Add link info to linkhash
-            for target, sources in newstuff.iteritems():
-                try:
-                    linkhash[target].update(set(sources))
-                except KeyError:
-                    linkhash[target] = set(sources)
-            
-            #Log status
-            linkfiles_read += 1
-            log("Read " + filename + " - " + 
-                str(100*linkfiles_read/len(linkfiles))[:4] + " % of link data.")
+    def spill(links):
+        filename = temp_dir+'links%d' % len(runs)+extensions['link_runs']
+        write_run(links, filename)
+        runs.append(filename)
+        log("Wrote sorted run %d of %d links" % (len(runs), len(links)))
+    
+    for linkfiles_read, filename in enumerate(linkfiles, 1):
+        with open(filename, 'rb') as f:
+            for target, sources in shared.iter_links(f):
+                target = redirects.get(target, target)
+                #Links to titles of no page parsed are of no use
+                page = page_ids.get(target)
+                if page is None:
+                    continue
+                #All pages parsed, rejected ones too, are in the page
+                #hashes. Any other sources are numbered after them.
+                source_pages = [page_ids.setdefault(link_title(source),
+                                                    len(page_ids))
+                                for source in sources]
+                for n in duplicates.get(page) or (page_file(page),):
+                    links.extend((n, page, source_page, source)
+                                 for source_page, source
+                                 in itertools.izip(source_pages, sources))
+                if len(links) >= shared.link_run_size:
+                    spill(links)
+                    links = []
         
-        log("Chunk finished - updating content files")
-        #Update concept with newly read link data
-        contentfiles = glob.glob(temp_dir + '*'+extensions['content'])
-        contentfiles_read = 0
-        for filename in contentfiles:
-            #Read file. Content is like {'article title' : {'text' : blah}}
-            with open(filename, 'r') as f:
-                content = shared.load(f)
-
-            #Search linkhash for links going TO concept                
-            for concept in content.keys():
-                try:
-                    sources = linkhash[concept]
-                except KeyError:
-                    sources = set([])  #Missing key => zero incoming links
-                
-                #Update link info for concept
-                try:
-                    content[concept]['links_in'] = set(content[concept]['links_in'])
-                    content[concept]['links_in'].update(sources)
-                except KeyError:
-                    content[concept]['links_in'] = sources
-                
-            #Save updated content
-            with open(filename, 'w') as f:
-                shared.dump(content, f)
-                
-            contentfiles_read += 1
-            if contentfiles_read % 100 == 0:
-                log("Fixed " + str(100*contentfiles_read/len(contentfiles))[:4]
-                    + "% of content files")
-        pass  #Proceed to next link chunk
+        #Log status
+        log("Read " + filename + " - " + 
+            str(100*linkfiles_read/len(linkfiles))[:4] + " % of link data.")
+    if links or not runs:
+        spill(links)
+    
+    #What, you think memory grows on trees?
+    del links, redirects, duplicates
+    gc.collect()    
 
 #==============================================================================
-#     Finished link processing 
+#     Merge runs to add incoming links to the content files.
 #     Remove unworthy concepts and combine concept/word lists.   
 #==============================================================================
     
-    #What, you think memory grows on trees?
-    del linkhash
-    gc.collect()    
+    log("Merging runs - updating content files")
+    merged = itertools.groupby(heapq.merge(*[read_run(filename)
+                                             for filename in runs]),
+                               key = lambda link: link[0])
+    group = next(merged, None)
+    #Links to concepts, for the link graph
+    concept_links = open(temp_dir+'concepts'+extensions['link_pairs'], 'wb')
     
     #Set of all approved concepts
     concept_list = set([])
+    #Articles kept by the parser, and those of them cleaned in this run
+    kept = set([])
+    cleaned = set([])
+    n_cleaned = 0  #Counting articles occurring more than once
     
-    #Purge inferior concepts (with insufficient incoming links)
-    for filename in contentfiles:
-        #Read in content file
+    for n, filename in enumerate(contentfiles):
+        #Hashes mapping the page number of each article in the file to the
+        #articles linking to it, and to the pages linking to it
+        linkhash = {}
+        link_pages = {}
+        if group and group[0] == n:
+            for _, target, source_page, source in group[1]:
+                try:
+                    linkhash[target].add(source)
+                    link_pages[target].add(source_page)
+                except KeyError:
+                    linkhash[target] = set([source])
+                    link_pages[target] = set([source_page])
+            group = next(merged, None)
+        
+        #Read file. Content is like {'article title' : {'text' : blah}}
         with open(filename, 'r') as f:
             content = shared.load(f)
         
         for concept in content.keys():
             entry = content[concept]
-            if 'links_in' in entry and len(entry['links_in']) >= min_links_in:
+            page = page_ids[link_title(concept)]
+            #Missing key => zero incoming links
+            sources = linkhash.get(page, set([]))
+            
+            #Update link info for concept
+            try:
+                entry['links_in'] = set(entry['links_in'])
+                entry['links_in'].update(sources)
+            except KeyError:
+                entry['links_in'] = sources
+            
+            #Purge inferior concepts (with insufficient incoming links)
+            kept.add(concept)
+            if not entry.get('unchanged'):
+                cleaned.add(concept)
+                n_cleaned += 1
+            source_pages = list(link_pages.get(page, ()))
+            if len(source_pages) >= min_links_in:
                 concept_list.add(concept)
+                linkgraph.write_links(source_pages, [page]*len(source_pages),
+                                      concept_links)
             else:
                 del content[concept]
         
+        #Save updated content
         with open(filename, 'w') as f:
             shared.dump(content, f)
+        
+        if (n+1) % 100 == 0:
+            log("Fixed " + str(100*(n+1)/len(contentfiles))[:4]
+                + "% of content files")
+    
+    concept_links.close()
+    for filename in runs:
+        os.remove(filename)
     
     log("Links done - saving index files")
 
@@ -126,21 +398,128 @@ def main():
     if not os.path.exists(matrix_dir):
         os.makedirs(matrix_dir)    
     
-    #Generate and save a concept index map. Structure: {concept : index}
-    concept_indices = {n: m for m,n in enumerate(concept_list)}
-    with open(matrix_dir+'concept2index.ind', 'w') as f:
-        shared.dump(concept_indices, f)
+    #Save the sha1 of each page, so the next build can skip unchanged ones.
+    #Pages kept by the parser but not as concepts are left out, as they may
+    #become concepts if more pages link to them.
+    pages = {'concept' : {}, 'rejected' : {}}
+    for filename in glob.glob(temp_dir + '*'+extensions['pages']):
+        with open(filename, 'rb') as f:
+            for title, sha1 in shared.load_pages(f).iteritems():
+                if title in concept_list:
+                    pages['concept'][title] = sha1
+                elif title not in kept:
+                    pages['rejected'][title] = sha1
+    with open(shared.pages_file, 'wb') as f:
+        shared.dump_page_status(pages, f)
+    del pages, kept
     
-    #Read in all wordlists and combine them.
-    words = set([])
-    for filename in glob.glob(temp_dir + '*'+extensions['words']):
-        with open(filename, 'r') as f:
-            words.update(shared.load(f))
+    #Read in all wordlists and combine them. The number of articles using
+    #each word is only summed if needed.
+    use_df = (shared.frequency_order or shared.min_df > 1 or
+              shared.max_df_ratio < 1)
+    max_df = shared.max_df_ratio*n_cleaned
+    wordfiles = glob.glob(temp_dir + '*'+extensions['words'])
+    #Updates, frequency_order and token_ids need all the words at hand. Else
+    #they're indexed in sorted order by slices, never held here as a whole.
+    sliced = not (os.path.exists(shared.update_file) or
+                  shared.frequency_order or shared.token_ids or
+                  shared.intermediate_format == 'json')
+    if sliced:
+        index_words(wordfiles, use_df, max_df)
+        words, df = set([]), Counter()
+    elif use_df:
+        df = merge_words(wordfiles, use_df)
+        log("Merged the words of %d files" % len(wordfiles))
+    else:
+        words = merge_words(wordfiles, use_df)
+        df = Counter()
+        log("Merged the words of %d files" % len(wordfiles))
+    
+    #Leave out rare and common words. Only words of articles cleaned in this
+    #run are counted, so an update only prunes words new to the vocabulary.
+    pruned = set([])
+    if use_df and not sliced:
+        words = set(word for word, n in df.iteritems()
+                    if shared.min_df <= n <= max_df)
+        pruned.update(word for word in df if word not in words)
+        log("Kept %d of %d words" % (len(words), len(df)))
+    
+    def frequency_rank(word):
+        '''Sort key putting the words used by most articles first.'''
+        return (-df[word], word)
+    rank = frequency_rank if shared.frequency_order else None
+    
+    if os.path.exists(shared.update_file):
+        log("Updating indices of previous build")
+        old_concepts = shared.load_index(matrix_dir+'concept2index.ind')
+        old_words = shared.load_index(matrix_dir+'word2index.ind')
+        concept_indices, moved = update_indices(old_concepts, concept_list)
+        #Words of unchanged articles aren't known, so all old ones are kept.
+        #Words left out before may be in unchanged articles, whose counts of
+        #them are lost, so they are left out until the next full build.
+        if os.path.exists(shared.pruned_file):
+            with open(shared.pruned_file, 'rb') as f:
+                pruned.update(shared.load_words(f))
+        words.difference_update(pruned)
+        words.update(old_words)
+        pruned.difference_update(old_words)
+        word_indices = update_indices(old_words, words, rank)[0]
         
-    #Generate and save a word index map. Structure: {word : index}
-    word_indices = {n: m for m,n in enumerate(words)}
-    with open(matrix_dir+'word2index.ind', 'w') as f:
-        shared.dump(word_indices, f)
+        #Columns of concepts that are gone or whose article was cleaned
+        #again, so their counts must be replaced
+        cleared = [j for concept, j in old_concepts.iteritems()
+                   if concept not in concept_list or concept in cleaned]
+        with open(shared.update_file, 'r') as f:
+            update = shared.load(f)
+        update.update({'old_shape' : [len(old_words), len(old_concepts)],
+                       'cleared' : sorted(cleared),
+                       'moved' : sorted(moved.items())})
+        with open(shared.update_file, 'w') as f:
+            shared.dump(update, f)
+        log("%d concepts added, %d changed or removed and %d moved" %
+            (len(concept_list.difference(old_concepts)), len(cleared),
+             len(moved)))
+        #Close the memory maps before the files are replaced
+        del old_concepts, old_words
+    else:
+        #Structure: {concept/word : index}
+        concept_indices = {n: m for m,n in enumerate(concept_list)}
+        words = sorted(words, key = rank)
+        word_indices = {n: m for m,n in enumerate(words)}
+    
+    #Save concept and word index maps, and the words left out
+    if not sliced:
+        with open(shared.pruned_file, 'wb') as f:
+            shared.dump_words(pruned, [df[word] for word in pruned], f)
+        with open(matrix_dir+'word2index.ind', 'wb') as f:
+            shared.dump_index(word_indices, f)
+    with open(matrix_dir+'concept2index.ind', 'wb') as f:
+        shared.dump_index(concept_indices, f)
+    
+    #Save the links between concepts, numbered like them
+    page_concepts = np.full(len(page_ids), -1, dtype = linkgraph.link_dtype)
+    for concept, index in concept_indices.iteritems():
+        page_concepts[page_ids[link_title(concept)]] = index
+    concept_graph = linkgraph.build_graph_from_file(concept_links.name,
+                                                    page_concepts,
+                                                    len(concept_indices))
+    linkgraph.save_graph(concept_graph)
+    log("Link graph of %d concepts and %d links" % (len(concept_indices),
+                                                    concept_graph.nnz))
+    os.remove(concept_links.name)
+    del concept_graph, page_ids, page_concepts
+    
+    #Map the word ids used in each count file to matrix rows, or -1 for
+    #words left out
+    if shared.token_ids:
+        log("Mapping word ids to indices")
+        for filename in glob.glob(temp_dir + '*'+extensions['words']):
+            with open(filename, 'rb') as f:
+                rows = [word_indices.get(word, -1)
+                        for word in shared.load_words(f)]
+            base = filename[:-len(extensions['words'])]
+            with open(base+extensions['word_map'], 'wb') as f:
+                shared.write_array(rows, f, np.int64)
     
     log("Wrapping up.")
     #Attempt to notify that job is done
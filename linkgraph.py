@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+'''Sparse graph of the links between concepts, saved by generate_indices.py.
+The graph is a CSR adjacency matrix with a 1 in row i, column j if concept i
+links to concept j, where i and j are the indices of concept2index.ind, so
+link statistics like degrees and PageRank can be computed with sparse matrix
+operations instead of reading the content files.
+Run as a script to list the concepts with the highest PageRank.
+Usage: python linkgraph.py [--top N] [--damping D]'''
+
+from __future__ import division
+import argparse
+import os
+import numpy as np
+import scipy.sparse as sps
+import shared
+
+link_dtype = np.dtype('<i4')  #Node numbers of links saved to disk
+
+def build_graph(sources, targets, n):
+    '''Returns the adjacency matrix of n nodes with links from sources[k] to
+    targets[k]. Links occurring more than once are counted once.'''
+    graph = sps.coo_matrix((np.ones(len(sources), dtype = np.int8),
+                            (np.asarray(sources), np.asarray(targets))),
+                           shape = (n, n)).tocsr()
+    graph.data[:] = 1
+    return graph
+
+def write_links(sources, targets, file_handle):
+    '''Appends links from sources[k] to targets[k] to a file, as pairs of
+    32 bit node numbers.'''
+    pairs = np.empty((len(sources), 2), dtype = link_dtype)
+    pairs[:, 0] = sources
+    pairs[:, 1] = targets
+    file_handle.write(pairs.tobytes())
+
+def read_links(filename, block_size = 10**7):
+    '''Generates (sources, targets) arrays of the links in a file written by
+    write_links, block_size links at a time.'''
+    if os.path.getsize(filename) == 0:
+        return
+    pairs = np.memmap(filename, dtype = link_dtype, mode = 'r').reshape(-1, 2)
+    for start in xrange(0, len(pairs), block_size):
+        block = np.array(pairs[start:start+block_size])
+        yield block[:, 0], block[:, 1]
+
+def build_graph_from_file(filename, labels, n, block_size = 10**7):
+    '''Returns the adjacency matrix of the links in a file written by
+    write_links, between the nodes with a label, numbered by their label
+    as in relabel. The file is read twice, a block at a time: once to count
+    the links from each node, and once to put them in place, so only the
+    matrix itself is held in memory.'''
+    def labelled(block_size):
+        for sources, targets in read_links(filename, block_size):
+            rows, columns = labels[sources], labels[targets]
+            keep = (rows >= 0) & (columns >= 0)
+            yield rows[keep], columns[keep]
+    
+    counts = np.zeros(n, dtype = np.int64)
+    for rows, columns in labelled(block_size):
+        counts += np.bincount(rows, minlength = n)
+    indptr = np.zeros(n+1, dtype = np.int64)
+    np.cumsum(counts, out = indptr[1:])
+    indices = np.empty(indptr[-1], dtype = link_dtype)
+    free = indptr[:-1].copy()  #Next free position in each row
+    for rows, columns in labelled(block_size):
+        order = np.argsort(rows, kind = 'mergesort')
+        rows, columns = rows[order], columns[order]
+        #Position of each link among those of its row in this block
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        indices[free[rows] + rank] = columns
+        free += np.bincount(rows, minlength = n)
+    graph = sps.csr_matrix((np.ones(len(indices), dtype = np.int8), indices,
+                            indptr), shape = (n, n))
+    graph.sum_duplicates()
+    graph.data[:] = 1
+    return graph
+
+def in_degree(graph):
+    '''Number of links to each node.'''
+    return np.bincount(graph.indices, minlength = graph.shape[1])
+
+def out_degree(graph):
+    '''Number of links from each node.'''
+    return np.diff(graph.indptr)
+
+def degree_filter(graph, min_in = 0, min_out = 0):
+    '''Returns a boolean array marking the nodes with at least min_in links
+    to them and min_out links from them.'''
+    return (in_degree(graph) >= min_in) & (out_degree(graph) >= min_out)
+
+def relabel(graph, labels, n):
+    '''Returns the graph between the nodes with a label, numbered by their
+    label. labels gives the new number of each node, or -1 to drop it.'''
+    coo = graph.tocoo()
+    rows, columns = labels[coo.row], labels[coo.col]
+    keep = (rows >= 0) & (columns >= 0)
+    return build_graph(rows[keep], columns[keep], n)
+
+def pagerank(graph, damping = 0.85, tolerance = 1e-10, max_iterations = 100):
+    '''Computes the PageRank of each node by power iteration. Nodes without
+    outgoing links distribute their rank evenly. Returns an array summing
+    to one.'''
+    n = graph.shape[0]
+    if n == 0:
+        return np.zeros(0)
+    degree = out_degree(graph).astype(float)
+    dangling = degree == 0
+    #Row normalized transpose, so each node passes its rank on evenly
+    scale = sps.diags(np.where(dangling, 0, 1/np.maximum(degree, 1)))
+    transition = (scale*graph).T.tocsr()
+    rank = np.ones(n)/n
+    for _ in xrange(max_iterations):
+        spread = damping*rank[dangling].sum()/n + (1-damping)/n
+        new_rank = damping*(transition*rank) + spread
+        change = np.abs(new_rank - rank).sum()
+        rank = new_rank
+        if change < tolerance:
+            break
+    return rank
+
+def save_graph(graph, filename = None):
+    with open(filename or shared.link_graph_file, 'w') as f:
+        shared.mdump(graph, f)
+
+def load_graph(filename = None):
+    with open(filename or shared.link_graph_file, 'r') as f:
+        return shared.mload(f)
+
+def main():
+    argparser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+    argparser.add_argument('--top', type = int, default = 20,
+                           help = "Number of concepts to list")
+    argparser.add_argument('--damping', type = float, default = 0.85)
+    args = argparser.parse_args()
+
+    graph = load_graph()
+    concept2index = shared.load_index(shared.matrix_dir+'concept2index.ind')
+    print "%d concepts, %d links" % (graph.shape[0], graph.nnz)
+    rank = pagerank(graph, args.damping)
+    degree = in_degree(graph)
+    print "%-10s %8s %s" % ('pagerank', 'links in', 'concept')
+    for j in np.argsort(-rank)[:args.top]:
+        print "%-10.6f %8d %s" % (rank[j], degree[j],
+                                  concept2index.string(j).encode('utf8'))
+
+if __name__ == '__main__':
+    main()
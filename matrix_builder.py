@@ -2,15 +2,24 @@
 '''Builds a huge sparse matrix of Term frequency/Inverse Document Frequency 
 (TFIDF) of the previously extracted words and concepts.
 First a matrix containing simply the number of occurrences of word i in the
-article corresponding to concept j is build (in DOK format as that is faster
-for iterative construction), then the matrix is converted to sparse row format
-(CSR), TFIDF values are computed, each row is normalized and finally pruned.'''
+article corresponding to concept j is build (as arrays of (i, j, count)
+triplets, which are converted to a matrix at once), then the matrix is
+converted to sparse row format (CSR), TFIDF values are computed, each row is
+normalized and finally pruned.
+The counts of each batch of content files are appended to a part file per
+chunk of rows, and the parts of each chunk are summed once at the end, so
+chunks aren't read and written again for every batch.
+The count matrix is kept, so a later incremental build only has to replace
+the columns of changed articles and redo TFIDF for the rows they affect. As
+rows are normalized, the IDF factor cancels out, so other rows don't change.'''
 
 from __future__ import division
 import scipy.sparse as sps
 import numpy as np
 from collections import Counter
 import glob
+import itertools
+import multiprocessing
 import shared
 import sys
 import os
@@ -23,21 +32,354 @@ log = shared.logmaker(logfile)
 
 #import shared parameters
 from shared import (extensions, matrix_dir, prune, temp_dir, column_chunk_size,
-                    row_chunk_size, datatype)
+                    row_chunk_size, datatype, window_size, cutoff,
+                    count_processes, weight_processes)
+
+def tfidf_rows(mtx, rows, n_concepts):
+    '''Converts the word counts in the rows of a CSR matrix marked in the
+    boolean array rows to TF-IDF, normalizes them and prunes the result.
+    The whole matrix is weighted at once, and the matrix is changed in place.
+    Returns the number of rows converted and the number of entries pruned
+    from each row.'''
+    assert mtx.dtype.kind == 'f'  #Non floats round to zero w/o warning
+    #Number of documents containing each word, and the row of each entry
+    n_docs = np.diff(mtx.indptr)
+    rows = rows & (n_docs > 0)
+    entry_rows = np.repeat(np.arange(mtx.shape[0]), n_docs)
+    entries = rows[entry_rows]
+    entry_rows = entry_rows[entries]
+    
+    #Map all elements to TF-IDF
+    idf = np.log(n_concepts/np.maximum(n_docs, 1))
+    data = (1+np.log(mtx.data[entries]))*idf[entry_rows]
+    
+    #Normalize the rows. Words in every concept have an IDF, and so a norm,
+    #of zero and are left as zeros
+    norms = np.sqrt(np.bincount(entry_rows, weights = data**2,
+                                minlength = mtx.shape[0]))
+    normfact = np.zeros(len(norms))
+    np.divide(1.0, norms, out = normfact, where = norms > 0)
+    data *= normfact[entry_rows]
+    mtx.data[entries] = data
+    
+    if prune:
+        pruned = prune_rows(mtx, rows)
+    else:
+        pruned = np.zeros(mtx.shape[0], dtype = np.int64)
+    return np.count_nonzero(rows), pruned
+
+def prune_rows(mtx, rows):
+    '''Inverted index pruning of the normalized TF-IDF in the rows of a CSR
+    matrix marked in the boolean array rows, in place. With the entries of a
+    row sorted in descending order, the row is truncated at the first entry
+    which is at most 1/cutoff times the entry window_size places later, so
+    the long tail of small values is dropped. All rows are sorted and
+    searched at once. Returns the number of entries set to zero in each row.
+    The truncation point never splits entries of equal value, as the
+    condition would then be met an entry earlier, so the result doesn't
+    depend on how ties are sorted.'''
+    n_docs = np.diff(mtx.indptr)
+    pruned = np.zeros(mtx.shape[0], dtype = np.int64)
+    #Don't prune if the windows exceeds the array bounds (duh)
+    rows = rows & (n_docs > window_size)
+    if not rows.any():
+        return pruned
+    entry_rows = np.repeat(np.arange(mtx.shape[0]), n_docs)
+    entries = np.flatnonzero(rows[entry_rows])
+    entry_rows = entry_rows[entries]
+    
+    #Sort the entries of each row, keeping the rows in order
+    order = np.lexsort((-mtx.data[entries], entry_rows))
+    values = mtx.data[entries[order]]
+    #Position of each entry in its sorted row
+    lengths = n_docs[rows]
+    position = (np.arange(len(values)) -
+                np.repeat(np.cumsum(lengths) - lengths, lengths))
+    
+    #Entries where the pruning condition is met, if the window fits in
+    #their row
+    n = len(values) - window_size
+    met = np.zeros(len(values), dtype = bool)
+    met[:n] = ((position[:n] < np.repeat(lengths - window_size, lengths)[:n])
+               & (values[window_size:] >= cutoff*values[:n]))
+    
+    #Truncate, i.e. set the entries from the first of those on to zero
+    first = np.full(mtx.shape[0], len(values), dtype = np.int64)
+    hits = np.flatnonzero(met)
+    np.minimum.at(first, entry_rows[hits], position[hits])
+    truncated = position >= first[entry_rows]
+    mtx.data[entries[order[truncated]]] = 0
+    pruned += np.bincount(entry_rows[truncated], minlength = mtx.shape[0])
+    return pruned
+
+class TripletBuffer(object):
+    '''Growable arrays of (row, column, count) triplets of the count matrix,
+    converted to CSR in one go. Adding counts to a column again replaces
+    those of the same rows, like assigning them to the matrix would.'''
+    
+    def __init__(self, shape, size = 2**16):
+        self.shape = shape
+        self.rows = np.empty(size, dtype = np.int64)
+        self.columns = np.empty(size, dtype = np.int64)
+        self.counts = np.empty(size, dtype = datatype)
+        self.size = 0
+        self.spans = {}  #{column : [(start, end)]} of the triplets added
+    
+    def reserve(self, n):
+        '''Makes room for n more triplets, doubling the arrays if needed.'''
+        if self.size + n <= len(self.rows):
+            return None
+        capacity = max(self.size + n, 2*len(self.rows))
+        for name in ('rows', 'columns', 'counts'):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype = old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+    
+    def add(self, rows, columns, counts):
+        '''Adds arrays of triplets.'''
+        n = len(rows)
+        self.reserve(n)
+        end = self.size + n
+        self.rows[self.size:end] = rows
+        self.columns[self.size:end] = columns
+        self.counts[self.size:end] = counts
+        self.size = end
+    
+    def add_column(self, j, rows, counts):
+        '''Adds the counts of the words of concept j.'''
+        spans = self.spans.setdefault(j, [])
+        for start, end in spans:
+            self.counts[start:end][np.in1d(self.rows[start:end], rows)] = 0
+        spans.append((self.size, self.size + len(rows)))
+        self.add(rows, np.repeat(j, len(rows)), counts)
+    
+    def tocsr(self):
+        '''Returns the triplets as a CSR matrix and empties the buffer.'''
+        keep = np.flatnonzero(self.counts[:self.size])
+        mtx = sps.coo_matrix((self.counts[keep],
+                              (self.rows[keep], self.columns[keep])),
+                             shape = self.shape).tocsr()
+        self.size = 0
+        self.spans = {}
+        return mtx
+
+def read_counts(filename, concept2index):
+    '''Reads the word ids and counts stored for a content file when
+    token ids are used. Returns arrays of rows, columns and counts.'''
+    base = filename[:-len(extensions['content'])]
+    with open(base+extensions['counts'], 'rb') as f:
+        titles, lengths, word_ids, counts = shared.load_counts(f)
+    with open(base+extensions['word_map'], 'rb') as f:
+        word_rows = shared.read_array(f, np.int64)
+    
+    #Concepts and words removed by generate_indices are left out
+    columns = np.array([concept2index.get(title, -1) for title in titles],
+                       dtype = np.int64)
+    columns = np.repeat(columns, lengths)
+    rows = word_rows[word_ids]
+    keep = (columns >= 0) & (rows >= 0)
+    return rows[keep], columns[keep], counts[keep]
+
+def count_file(filename, word2index, concept2index, triplets):
+    '''Adds the word counts of the changed articles of a content file to a
+    TripletBuffer.'''
+    if shared.token_ids:
+        triplets.add(*read_counts(filename, concept2index))
+        return None
+    with open(filename, 'r') as f:
+        content = shared.load(f)
+    
+    #Rows of the words in this file, so each is only searched for once
+    word_rows = {}
+    
+    #Loop over concepts (columns) as so we don't waste time with rare words
+    for concept, entry, in content.iteritems():
+        #Unchanged articles are already counted
+        if entry.get('unchanged'):
+            continue
+        
+        #This is the column index (concept w. index j)
+        j = concept2index[concept]
+        
+        #Convert concept 'countmap' like so: {word : n}
+        wordmap = Counter(entry['text'].split())
+        
+        #Find row indices of the words, -1 if left out of the vocabulary
+        rows = []
+        for word in wordmap:
+            try:
+                rows.append(word_rows[word])
+            except KeyError:
+                rows.append(word2index.get(word, -1))
+                word_rows[word] = rows[-1]
+        rows = np.array(rows, dtype = np.int64)
+        counts = np.fromiter(wordmap.itervalues(), dtype = datatype,
+                             count = len(wordmap))
+        
+        #Add the number of times word i occurs in concept j to the matrix
+        found = rows >= 0
+        triplets.add_column(j, rows[found], counts[found])
+    return None
+
+#Word and concept index maps of a worker process
+worker_indices = None
+
+def init_worker(word_index_file, concept_index_file):
+    '''Opens the index maps in a worker process. They're passed by filename,
+    as memory maps can't be pickled, which Windows needs to start workers.'''
+    global worker_indices
+    worker_indices = (shared.load_index(word_index_file),
+                      shared.load_index(concept_index_file))
+
+def count_files(filenames):
+    '''Returns the count matrix of a group of content files, in CSR format.
+    Used by worker processes.'''
+    word2index, concept2index = worker_indices
+    triplets = TripletBuffer((len(word2index), len(concept2index)))
+    for filename in filenames:
+        count_file(filename, word2index, concept2index, triplets)
+    return triplets.tocsr()
+
+def overwrite(a, b):
+    '''Returns the matrix a with the entries of b assigned to it, like a
+    TripletBuffer does when a concept is added again.'''
+    pattern = b.copy()
+    pattern.data[:] = 1
+    kept = a - a.multiply(pattern)
+    kept.eliminate_zeros()
+    return (kept + b).tocsr()
+
+def reduce_pairwise(matrices, combine):
+    '''Combines a list of matrices in a tree, joining neighbours in pairs
+    until one is left, so no matrix is combined more than log2(n) times.'''
+    while len(matrices) > 1:
+        matrices = [combine(*matrices[k:k+2]) if k+1 < len(matrices)
+                    else matrices[k] for k in xrange(0, len(matrices), 2)]
+    return matrices[0]
+
+def write_part(mtx, file_handle):
+    '''Appends a CSR matrix to a part file as its indptr, indices and data.'''
+    shared.write_array(mtx.indptr, file_handle, np.int64)
+    shared.write_array(mtx.indices, file_handle, np.int64)
+    shared.write_array(mtx.data, file_handle, datatype)
+
+def read_parts(file_handle, shape):
+    '''Generates the matrices of the given shape in a part file.'''
+    while file_handle.read(1):
+        file_handle.seek(-1, os.SEEK_CUR)
+        indptr = shared.read_array(file_handle, np.int64)
+        indices = shared.read_array(file_handle, np.int64)
+        data = shared.read_array(file_handle, datatype)
+        yield sps.csr_matrix((data, indices, indptr), shape = shape)
+
+def sum_matrices(matrices, shape):
+    '''Sums CSR matrices by sorting all their entries at once, rather than
+    adding them one at a time.'''
+    matrices = list(matrices)
+    if len(matrices) == 1:
+        return matrices[0]
+    if not matrices:
+        return sps.csr_matrix(shape, dtype = datatype)
+    rows = np.concatenate([np.repeat(np.arange(shape[0]), np.diff(m.indptr))
+                           for m in matrices])
+    columns = np.concatenate([m.indices for m in matrices])
+    data = np.concatenate([m.data for m in matrices])
+    return sps.coo_matrix((data, (rows, columns)), shape = shape).tocsr()
+
+def remap_columns(mtx, update, shape):
+    '''Applies the column changes of an incremental update to a matrix chunk
+    from the previous build: entries in cleared columns are dropped, moved
+    columns get their new index, and the matrix is resized to shape.
+    Returns the new matrix and a boolean array marking the rows that lost
+    entries.'''
+    coo = mtx.tocoo()
+    n_old = update['old_shape'][1]
+    cleared = np.zeros(n_old, dtype = bool)
+    cleared[update['cleared']] = True
+    columns = np.arange(n_old)
+    for old, new in update['moved']:
+        columns[old] = new
+    
+    lost = cleared[coo.col]
+    touched = np.zeros(shape[0], dtype = bool)
+    touched[coo.row[lost]] = True
+    keep = ~lost
+    result = sps.coo_matrix((coo.data[keep],
+                             (coo.row[keep], columns[coo.col[keep]])),
+                            shape = shape, dtype = mtx.dtype)
+    return result.tocsr(), touched
+
+def select_rows(mtx, rows):
+    '''Returns a copy of a CSR matrix with only the rows marked in the
+    boolean array rows.'''
+    ind = np.flatnonzero(rows)
+    selector = sps.csr_matrix((np.ones(len(ind), dtype = mtx.dtype),
+                               (ind, ind)), shape = (len(rows), len(rows)))
+    return (selector*mtx).tocsr()
+
+def weight_chunk(job):
+    '''Computes the TF-IDF of a count matrix chunk and saves it, replacing
+    the file atomically, so an interrupted build never leaves half a chunk.
+    job is (chunk number, boolean array of the rows to compute, incremental
+    update or None, number of concepts). Returns the chunk number, the
+    number of rows converted and entries weighted, and the number of
+    entries pruned from each row.'''
+    n, rows, update, n_concepts = job
+    with open(matrix_dir+str(n)+extensions['count_matrix'], 'r') as f:
+        mtx = shared.mload(f)
+    
+    #Keep TF-IDF of rows with unchanged counts from the previous build
+    tfidf_filename = matrix_dir+str(n)+extensions['matrix']
+    previous = None
+    if update and os.path.exists(tfidf_filename):
+        #Rows containing all concepts are zero due to IDF, so they
+        #change with the number of concepts
+        n_docs = np.diff(mtx.indptr)
+        rows = rows | (n_docs == n_concepts)
+        rows |= n_docs == update['old_shape'][1]
+        with open(tfidf_filename, 'r') as f:
+            previous = remap_columns(shared.mload(f), update,
+                                     mtx.shape)[0]
+    
+    #Update matrix
+    converted, pruned = tfidf_rows(mtx, rows, n_concepts)
+    weighted = np.diff(mtx.indptr)[rows].sum()
+    
+    if previous is not None:
+        mtx = select_rows(mtx, rows) + select_rows(previous, ~rows)
+    
+    #Keep it sparse - no need to store zeroes
+    mtx.eliminate_zeros()
+    with open(tfidf_filename+'.tmp', 'w') as f:
+        shared.mdump(mtx, f)
+    if os.name == 'nt' and os.path.exists(tfidf_filename):
+        os.remove(tfidf_filename)  #Windows can't rename over it
+    os.rename(tfidf_filename+'.tmp', tfidf_filename)
+    return n, converted, weighted, pruned
 
 def main():
-    #Cleanup
-    for f in glob.glob(matrix_dir + '/*'+extensions['matrix']):
+    #An incremental update changes the matrices of the previous build
+    update = None
+    if os.path.exists(shared.update_file):
+        with open(shared.update_file, 'r') as f:
+            update = shared.load(f)
+        log("Updating previous build")
+    else:
+        #Cleanup
+        for ext in ('matrix', 'count_matrix'):
+            for f in glob.glob(matrix_dir + '/*'+extensions[ext]):
+                os.remove(f)
+    #Parts and chunks left by an interrupted build
+    for f in glob.glob(temp_dir + '*'+extensions['count_parts']):
+        os.remove(f)
+    for f in glob.glob(matrix_dir + '*'+extensions['matrix']+'.tmp'):
         os.remove(f)
-
-    #Set pruning parameters
-    window_size = shared.window_size
-    cutoff = shared.cutoff
     
-    #Read in dicts mapping words and concepts to their respective indices
+    #Open maps of words and concepts to their respective indices
     log("Reading in word/index data")
-    word2index = shared.load(open(matrix_dir+'word2index.ind', 'r'))
-    concept2index = shared.load(open(matrix_dir+'concept2index.ind', 'r'))
+    word2index = shared.load_index(matrix_dir+'word2index.ind')
+    concept2index = shared.load_index(matrix_dir+'concept2index.ind')
     log("...Done!")
     
 #==============================================================================
@@ -51,9 +393,28 @@ def main():
     #Determine matrix dimensions
     matrix_shape = (n_words, n_concepts)
     
-    #Allocate sparse matrix. Dict-of-keys should be faster for iterative
-    #construction. Convert to csr for fast row operations later.
-    mtx = sps.dok_matrix(matrix_shape, dtype = datatype)
+    def chunk_shape(n):
+        '''Shape of the n'th submatrix.'''
+        return (min(row_chunk_size, n_words - n*row_chunk_size), n_concepts)
+    
+    #Rows whose counts change, so their TF-IDF must be computed
+    if update:
+        touched = np.zeros(n_words, dtype = bool)
+        #Remove counts of changed articles and make room for new ones
+        for filename in glob.glob(matrix_dir+'*'+extensions['count_matrix']):
+            n = int(os.path.basename(filename).split('.')[0])
+            with open(filename, 'r') as f:
+                submatrix, lost = remap_columns(shared.mload(f), update,
+                                                chunk_shape(n))
+            touched[n*row_chunk_size : n*row_chunk_size + len(lost)] |= lost
+            with open(filename, 'w') as f:
+                shared.mdump(submatrix, f)
+    else:
+        touched = np.ones(n_words, dtype = bool)
+    
+    #Collect the counts as triplets, which are converted to csr for fast row
+    #operations later.
+    triplets = TripletBuffer(matrix_shape)
     
     def matrix_chopper(matrix, dim):
         '''Generator to split a huge matrix into small submatrices, which can
@@ -61,73 +422,98 @@ def main():
         This is handy both when constructing the matrix (building the whole
         matrix without saving to files in the process takes about 50 gigs RAM),
         and when applying it, as this allows one to load only the submatrix
-        relevant to a given word.'''
+        relevant to a given word.
+        The submatrices share the arrays of the matrix rather than copying
+        them.'''
         ind = 0
         counter = 0
         rows = matrix.get_shape()[0]
         while ind < rows:
             end = min(ind+dim, rows)
+            start, stop = matrix.indptr[ind], matrix.indptr[end]
             #Return pair of submatrix number and the submatrix itself
-            yield counter, sps.vstack([matrix.getrow(i)\
-                                    for i in xrange(ind, end)], format = 'csr')
+            yield counter, sps.csr_matrix((matrix.data[start:stop],
+                                           matrix.indices[start:stop],
+                                           matrix.indptr[ind:end+1] - start),
+                                          shape = (end-ind, matrix.shape[1]))
             counter += 1
             ind += dim
     
     def writeout():
-        '''Saves the matrix as small submatrrices in separate files.'''
+        '''Appends the counts of the submatrices to the part files of their
+        chunks.'''
         for n, submatrix in matrix_chopper(mtx, row_chunk_size):
-            filename = matrix_dir+str(n)+extensions['matrix']
-            #Update submatrix if it's already partially calculated
+            if submatrix.nnz == 0:
+                continue
+            #Mark rows getting new counts
+            touched[n*row_chunk_size + 
+                    np.flatnonzero(np.diff(submatrix.indptr))] = True
+            with open(temp_dir+str(n)+extensions['count_parts'], 'ab') as f:
+                write_part(submatrix, f)
+        return None
+    
+    def merge_parts():
+        '''Sums the parts of each chunk, and the counts of the previous build
+        if any, and saves them as the count matrix.'''
+        for n in xrange(-(-n_words//row_chunk_size)):
+            filename = matrix_dir+str(n)+extensions['count_matrix']
+            partname = temp_dir+str(n)+extensions['count_parts']
             log("Writing out chunk %s" % n)
-            try:
+            parts = []
+            if os.path.exists(filename):
                 with open(filename, 'r') as f:
-                    submatrix = submatrix + shared.mload(f)
-                #
-            except IOError:
-                pass #File doesn't exist yet, so no need to change mtx
-            
-            #Dump the submatrix to file
+                    parts.append(shared.mload(f))
+            if os.path.exists(partname):
+                with open(partname, 'rb') as f:
+                    parts.extend(read_parts(f, chunk_shape(n)))
+                os.remove(partname)
             with open(filename, 'w') as f:
-                shared.mdump(submatrix, f)
+                shared.mdump(sum_matrices(parts, chunk_shape(n)), f)
         return None
     
     log("Constructing matrix.")
     filelist = glob.glob(temp_dir + '*'+extensions['content'])
     files_read = 0
-    for filename in filelist:
-        with open(filename, 'r') as f:
-            content = shared.load(f)
-        
-        #Loop over concepts (columns) as so we don't waste time with rare words
-        for concept, entry, in content.iteritems():
-            #This is the column index (concept w. index j)
-            j = concept2index[concept]
-            
-            #Convert concept 'countmap' like so: {word : n}
-            wordmap = Counter(entry['text'].split()).iteritems()
+    if count_processes > 1:
+        #Batches are split into groups of files counted by worker processes.
+        #Token counts are summed, while in text mode articles counted again
+        #replace earlier counts, so matrices are combined in file order.
+        pool = multiprocessing.Pool(count_processes, init_worker,
+                                    (matrix_dir+'word2index.ind',
+                                     matrix_dir+'concept2index.ind'))
+        for start in xrange(0, len(filelist), column_chunk_size):
+            batch = filelist[start : start+column_chunk_size]
+            size = -(-len(batch)//count_processes)
+            groups = [batch[k : k+size] for k in xrange(0, len(batch), size)]
+            if shared.token_ids:
+                mtx = sum_matrices(pool.map(count_files, groups),
+                                   matrix_shape)
+            else:
+                mtx = reduce_pairwise(pool.map(count_files, groups),
+                                      overwrite)
+            files_read += len(batch)
+            log("Processed content file no. %s of %s - %s" % (files_read,
+                len(filelist)-1, percentof(files_read, len(filelist))))
+            writeout()
+        pool.close()
+        pool.join()
+    else:
+        for filename in filelist:
+            count_file(filename, word2index, concept2index, triplets)
+            #Update file count
+            files_read += 1
+            log("Processed content file no. %s of %s - %s" % (files_read,
+                len(filelist)-1, percentof(files_read, len(filelist))))
             
-            #Add them all to the matrix
-            for word, count in wordmap:
-                #Find row index of the current word
-                i = word2index[word]
-    
-                #Add the number of times word i occurs in concept j to the matrix
-                mtx[i,j] = count
+            if files_read % column_chunk_size == 0:
+                mtx = triplets.tocsr()
+                writeout()
             #
-        #Update file count
-        files_read += 1
-        log("Processed content file no. %s of %s - %s"
-            % (files_read, len(filelist)-1, percentof(files_read, len(filelist))))
         
-        if files_read % column_chunk_size == 0:
-            mtx = mtx.tocsr()
-            writeout()
-            mtx = sps.dok_matrix(matrix_shape)
-        #
-    
-    #Convert matrix to CSR format and write to files.
-    mtx = mtx.tocsr()
-    writeout()
+        #Convert matrix to CSR format and write to files.
+        mtx = triplets.tocsr()
+        writeout()
+    merge_parts()
 
 #==============================================================================
 # Count matrix/matrices constructed - computing TF-IDF
@@ -135,76 +521,53 @@ def main():
 
     log("Done - computing TF-IDF")
     
-    #Grap list of matrix files (containing the submatrices from before)
-    matrixfiles = glob.glob(matrix_dir + "*" + extensions['matrix'])
+    #Grap list of count matrix files (containing the submatrices from before)
+    matrixfiles = glob.glob(matrix_dir + "*" + extensions['count_matrix'])
     words_processed = 0  #for logging purposes    
+    #Pruning statistics: entries weighted and pruned, and rows pruned
+    entries_weighted = entries_pruned = rows_pruned = 0
     
+    #Chunks are weighted in any order, by worker processes if enabled
+    jobs = []
     for filename in matrixfiles:
-        with open(filename, 'r') as f:
-            mtx = shared.mload(f)
-        
-        #Number of words in a submatrix
-        n_rows = mtx.get_shape()[0]
-        
-        for w in xrange(n_rows):
-            #Grap non-zero elements from the row corresonding to word w
-            row = mtx.data[mtx.indptr[w] : mtx.indptr[w+1]]
-            if len(row) == 0:
-                continue
-            
-            #Make a vectorized function to convert a full row to TF-IDF
-            f = np.vectorize(lambda m_ij: (1+np.log(m_ij))*
-                             np.log(n_concepts/len(row)))
+        n = int(os.path.basename(filename).split('.')[0])
+        rows = touched[n*row_chunk_size : n*row_chunk_size + chunk_shape(n)[0]]
+        jobs.append((n, rows, update, n_concepts))
+    if weight_processes > 1:
+        pool = multiprocessing.Pool(weight_processes)
+        results = pool.imap_unordered(weight_chunk, jobs)
+    else:
+        results = itertools.imap(weight_chunk, jobs)
     
-            #Map all elements to TF-IDF and update matrix
-            row = f(row)
-            
-            #Normalize the row
-            assert row.dtype.kind == 'f'  #Non floats round to zero w/o warning
-            normfact = 1.0/np.linalg.norm(row)            
-            row *= normfact
-            
-            #Start inverted index pruning
-            if prune:                
-                #Number of documents containing w
-                n_docs = len(row)        
-                
-                #Don't prune if the windows exceeds the array bounds (duh)
-                if window_size < n_docs:
-                    
-                    #Obtain list of indices such that row[index] is sorted
-                    indices = np.argsort(row)[::-1]
-            
-                    #Generate a sorted row
-                    sorted_row = [row[index] for index in indices]
-            
-                    #Go through sorted row and truncate when pruning condition is met
-                    for i in xrange(n_docs-window_size):
-                        if sorted_row[i+window_size] >= cutoff*sorted_row[i]:   
-                            #Truncate, i.e. set the remaining entries to zero
-                            sorted_row[i:] = [0]*(n_docs-i)
-                            break
-                        else:
-                            pass
-                        
-                    #Unsort to original positions
-                    for i in xrange(n_docs):    
-                        row[indices[i]] = sorted_row[i]
-                
-            #Update matrix
-            mtx.data[mtx.indptr[w] : mtx.indptr[w+1]] = row
-            
-            #Log it
-            words_processed += 1
-            if words_processed % 10**3 == 0:
-                log("Processing word %s of %s - %s" % 
-                    (words_processed, n_words,
-                     percentof(words_processed, n_words)))
+    for chunks_done, (n, converted, weighted, pruned) in enumerate(results, 1):
+        words_processed += converted
         
-        #Keep it sparse - no need to store zeroes
-        mtx.eliminate_zeros()
-        with open(filename, 'w') as f:
-            shared.mdump(mtx, f)
+        #Log it
+        log("Weighted chunk %s, %s of %s - word %s of %s - %s" % 
+            (n, chunks_done, len(matrixfiles), words_processed, n_words,
+             percentof(words_processed, n_words)))
+        if pruned.any():
+            log("Pruned %s of %s entries (%s) from %s rows - at most %s and "
+                "on average %.1f from a row" %
+                (pruned.sum(), weighted, percentof(pruned.sum(), weighted),
+                 np.count_nonzero(pruned), pruned.max(),
+                 pruned.sum()/np.count_nonzero(pruned)))
+        entries_weighted += weighted
+        entries_pruned += pruned.sum()
+        rows_pruned += np.count_nonzero(pruned)
+    if weight_processes > 1:
+        pool.close()
+        pool.join()
+    
+    if entries_weighted:
+        log("Pruned %s of %s entries (%s) from %s of %s rows" %
+            (entries_pruned, entries_weighted,
+             percentof(entries_pruned, entries_weighted), rows_pruned,
+             words_processed))
+    
+    #The matrices are now up to date
+    if update:
+        os.remove(shared.update_file)
     
     log("Done!")
     
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+'''On-disk cache of cleaned articles, so parsing a newer dump doesn't clean
+the articles whose wikitext is unchanged again.
+Entries are keyed by the sha1 of the raw text and hold the outgoing links
+and the cleaned text of the article, compressed, in an SQLite database.
+Each parse of a dump is a run, and entries remember the last run they were
+used in. When the database reaches its size limit, entries not used in this
+run or the previous one are evicted, as they're likely old revisions. If
+that doesn't make room, no more entries are added until the next run. A
+dump is read in the same order every time, so evicting the least recently
+used entries would throw out each one just before it's needed again, while
+entries used by the last run are kept, and keep giving hits. A limit below
+the size of the cleaned dump therefore gives a partial hit rate. Entries
+made by another version of the cleaning code are discarded when the cache
+is opened.'''
+
+import sqlite3
+import hashlib
+import zlib
+import json
+import os
+
+def page_key(text):
+    '''Returns the cache key of the raw wikitext of a page.'''
+    return hashlib.sha1(text.encode('utf8')).digest()
+
+def code_version(*modules):
+    '''Hash of the source code of modules, identifying the code which made
+    the cached results.'''
+    h = hashlib.sha1()
+    for module in modules:
+        with open(os.path.splitext(module.__file__)[0]+'.py', 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+class PageCache(object):
+    '''Cache of (links, cleaned text) of articles. Lookups are answered
+    right away, while new entries and the keys of hits are buffered until
+    flush() is called, so the database is written once per batch. The
+    number of the current run is stored in the database. Processes parsing
+    shards of the same dump share a run by passing its number.'''
+
+    def __init__(self, filename, max_size, version = '', run = None):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        #Shards parsed in parallel may share the cache, so wait for locks
+        self.db = sqlite3.connect(filename, timeout = 600)
+        self.max_size = max_size
+        self.db.execute('CREATE TABLE IF NOT EXISTS pages (key BLOB PRIMARY '
+                        'KEY, data BLOB, size INTEGER, used INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS pages_used ON pages '
+                        '(used)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY '
+                        'KEY, value TEXT)')
+        if self.get_meta('version') != version:
+            self.db.execute('DELETE FROM pages')
+            self.set_meta('version', version)
+        if self.get_meta('run') is None:
+            #Entries may have been marked by flush instead of run
+            self.db.execute('UPDATE pages SET used = 0')
+        if run is None:
+            run = int(self.get_meta('run') or 0) + 1
+            self.set_meta('run', run)
+        self.run = run
+        self.db.commit()
+        self.size = self.db.execute('SELECT SUM(size) FROM pages'
+                                    ).fetchone()[0] or 0
+        self.new_entries = []
+        self.used = []
+        self.evicted = False
+        self.full = False
+        self.hits = 0
+        self.misses = 0
+
+    def get_meta(self, name):
+        row = self.db.execute('SELECT value FROM meta WHERE name = ?',
+                              (name,)).fetchone()
+        return row and row[0]
+
+    def set_meta(self, name, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        (name, str(value)))
+
+    def get(self, key):
+        '''Returns the cached (links, text) for key, or None.'''
+        row = self.db.execute('SELECT data FROM pages WHERE key = ?',
+                              (sqlite3.Binary(key),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used.append((self.run, sqlite3.Binary(key)))
+        return tuple(json.loads(zlib.decompress(row[0]).decode('utf8')))
+
+    def put(self, key, links, text):
+        '''Adds the links and cleaned text (None if not cleaned) of a page,
+        unless the cache is full.'''
+        if self.full:
+            return None
+        data = zlib.compress(json.dumps([list(links), text]), 1)
+        self.new_entries.append((sqlite3.Binary(key), sqlite3.Binary(data),
+                                 len(data), self.run))
+
+    def flush(self):
+        '''Marks the entries hit as used in this run, and writes the new
+        entries which fit within the size limit. The first time they don't
+        fit, entries older than the previous run are evicted. If an entry
+        still doesn't fit, the cache is full and no more are added.'''
+        self.db.executemany('UPDATE pages SET used = ? WHERE key = ?',
+                            self.used)
+        self.used = []
+        if self.size + sum(entry[2] for entry in self.new_entries) > \
+           self.max_size:
+            if not self.evicted:
+                self.db.execute('DELETE FROM pages WHERE used < ?',
+                                (self.run - 1,))
+                self.evicted = True
+            #Entries already cached are ignored, but they're rare as only
+            #misses are added, so the size is only recounted when it seems
+            #full. Shards parsed in parallel may also have added entries.
+            self.size = self.db.execute('SELECT SUM(size) FROM pages'
+                                        ).fetchone()[0] or 0
+        added = []
+        for entry in self.new_entries:
+            if self.size + entry[2] > self.max_size:
+                self.full = True
+                break
+            added.append(entry)
+            self.size += entry[2]
+        self.db.executemany('INSERT OR IGNORE INTO pages VALUES (?, ?, ?, ?)',
+                            added)
+        self.new_entries = []
+        self.db.commit()
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -8,24 +8,66 @@ import urllib
 import scipy.sparse as sps
 import numpy as np
 import json
+import collections
+import mmap
+import io
+import bisect
+import struct
 
 #==============================================================================
 # Parameters that should be adjusted according to available ressources
 #==============================================================================
 
 #Number of data files to process at a time. Highly RAM-dependent
-link_chunk_size = 600 #600 is good for a standard laptop
+link_run_size = 5*10**6 #Links sorted in memory at a time. ~1 GB RAM
 column_chunk_size = 500 #These take up a bit more space than links
 row_chunk_size = 10**4 #No of words pr file
 
+#Number of processes used to clean articles while parsing the XML dump.
+parse_processes = 1 #1 to parse serially
+parse_batch_size = 100 #Articles sent to a worker process at a time
+link_cache_size = 10**5 #Canonical link titles cached while parsing
+#Processes merging the word lists in generate_indices.py. Each combines a
+#group of files, then a range of the vocabulary, which it indexes. 1 to merge
+#serially
+merge_processes = 1
+#Processes counting the words of content files in matrix_builder.py. 1 to
+#count serially
+count_processes = 1
+#Processes computing the TF-IDF of the matrix chunks. 1 to compute serially
+weight_processes = 1
+#Way of processing HTML when cleaning articles, see wikicleaner.html_engines.
+#'scan' only runs the patterns of tags found in an article, 'patterns' all.
+clean_engine = 'scan'
+#SQLite file caching cleaned articles by their raw text, so unchanged
+#articles in a newer dump aren't cleaned again. None to disable.
+page_cache = None #e.g. 'cache/pages.db'. Keep it outside temp_dir
+#Max bytes of cached data. Once full, articles not used by this or the last
+#run are evicted. A limit below the size of the cleaned dump only gives hits
+#for part of it
+page_cache_size = 20*2**30
+
 datatype = np.float64 #Must be float. Double precision might be pushing it
 indent = 4 #json indentation. 4 for readability - 0 for optimal storing
+#Format of word and link files from the XML parser and of the word and
+#concept index files. 'json' for debugging
+intermediate_format = 'binary'
+#Store articles as arrays of word ids and counts instead of text, so the
+#matrix can be built without any string handling.
+token_ids = False
 
 #Minimum number of links/words required to keep an article.
 min_links_in = 0   #5
 min_links_out = 0  #5
 min_words = 0  #100
 
+#Words in fewer than min_df articles, or in more than a fraction max_df_ratio
+#of them, are left out of the matrix. With frequency_order, words are indexed
+#by decreasing number of articles, so common words share the first chunks.
+min_df = 1  #1 keeps all words. 3 drops most typos and hapaxes
+max_df_ratio = 1.0
+frequency_order = False
+
 #Pruning parameters
 prune = True
 window_size = 100
@@ -69,12 +111,31 @@ def logmaker(filehandle):
 extensions = {'content' : '.raw',
               'words' : '.w',
               'links' : '.l',
-              'matrix' : '.mtx'}
+              'redirects' : '.r',
+              'counts' : '.cnt',  #Word ids and counts if token_ids is set
+              'word_map' : '.map',  #Maps word ids in .cnt files to rows
+              'pages' : '.pg',  #sha1 of each page parsed
+              'link_runs' : '.run',  #Sorted links, while joining them
+              'link_pairs' : '.lp',  #Links to concepts, by page number
+              'count_parts' : '.cpt',  #Counts of a row chunk, by batch
+              'word_parts' : '.wpt',  #Words of a vocabulary slice, by group
+              'word_slices' : '.wsl',  #Words indexed in a vocabulary slice
+              'matrix' : '.mtx',
+              'count_matrix' : '.cmtx'}  #Word counts before TF-IDF
 
 #File directories
 temp_dir = 'temp/' #Temporary files. Duh.
 matrix_dir = 'matrix/' #Files containing subspacess of TFIDF-matrix
 
+#sha1 of the pages used in the last build, for incremental updates
+pages_file = matrix_dir+'pages.ind'
+#Links between the concepts, as a sparse adjacency matrix
+link_graph_file = matrix_dir+'links.graph'
+#Words left out of the last build due to min_df and max_df_ratio
+pruned_file = matrix_dir+'pruned.w'
+#Describes an incremental update while it's in progress
+update_file = temp_dir+'update.json'
+
 #==============================================================================
 # The following methods are to be used istead of Python's default json dumps
 # for two reasons.:
@@ -131,5 +192,467 @@ def mload(file_handle):
     '''Loads CSR matrices from JSON dump.'''
     return json.load(file_handle, object_hook=reconstruct)
 
+#==============================================================================
+# Compact binary format for the word (.w) and link (.l) files written by the
+# XML parser. Strings are stored in tables of UTF-8 bytes preceded by their
+# number and total size, and link data as arrays of indices into such a
+# table. Each file starts with a magic string identifying its contents, so
+# readers can tell binary files from JSON ones and handle both.
+#==============================================================================
+
+WORDS_MAGIC = 'ESA-W2\n'
+LINKS_MAGIC = 'ESA-L1\n'
+COUNTS_MAGIC = 'ESA-C1\n'
+REDIRECTS_MAGIC = 'ESA-R1\n'
+PAGES_MAGIC = 'ESA-P1\n'
+INDEX_MAGIC = 'ESA-IX1\n'  #8 bytes, so the arrays following it are aligned
+index_dtype = np.dtype('<u4')
+
+def write_array(array, file_handle, dtype = index_dtype):
+    '''Writes a 1D integer array preceded by its length.'''
+    array = np.asarray(array, dtype = dtype)
+    file_handle.write(np.array([len(array)], dtype = '<u8').tobytes())
+    file_handle.write(array.tobytes())
+
+def read_array(file_handle, dtype = index_dtype):
+    '''Reads an array written by write_array.'''
+    dtype = np.dtype(dtype)
+    n = np.frombuffer(file_handle.read(8), dtype = '<u8')[0]
+    return np.frombuffer(file_handle.read(int(n)*dtype.itemsize),
+                         dtype = dtype)
+
+def write_strings(strings, file_handle, encoded = False):
+    '''Writes a sequence of (unicode) strings as UTF-8, separated by NUL
+    characters, which can't occur in XML. The number of strings and the size
+    of the table in bytes are written first. If encoded, the strings are
+    UTF-8 encoded already.'''
+    strings = list(strings)
+    if not encoded:
+        strings = [s.encode('utf8') for s in strings]
+    blob = '\x00'.join(strings)
+    file_handle.write(np.array([len(strings), len(blob)],
+                               dtype = '<u8').tobytes())
+    file_handle.write(blob)
+
+def read_strings(file_handle, decode = True):
+    '''Reads a list of unicode strings written by write_strings, or of UTF-8
+    encoded ones unless decode.'''
+    n, size = np.frombuffer(file_handle.read(16), dtype = '<u8')
+    blob = file_handle.read(int(size))
+    if n == 0:
+        return []
+    if not decode:
+        return blob.split('\x00')
+    #Decoding the whole table at once is much faster than string by string
+    return blob.decode('utf8').split(u'\x00')
+
+def is_binary(file_handle, magic):
+    '''Checks whether a file starts with the given magic string. If not,
+    the file position is reset to allow reading it as JSON.'''
+    if file_handle.read(len(magic)) == magic:
+        return True
+    file_handle.seek(0)
+    return False
+
+def dump_words(words, df, file_handle, format = None):
+    '''Writes a sequence of words and the number of articles containing each
+    of them, df, in the intermediate format (or format, if given). The file
+    must be opened in binary mode.'''
+    if (format or intermediate_format) == 'json':
+        dump({'words' : list(words), 'df' : np.asarray(df).tolist()},
+             file_handle)
+    else:
+        file_handle.write(WORDS_MAGIC)
+        write_strings(words, file_handle)
+        write_array(df, file_handle)
+
+def load_word_df(file_handle, decode = True):
+    '''Reads the words and their document frequencies from a binary or JSON
+    word file. Returns a list of words, UTF-8 encoded unless decode, and an
+    array of frequencies.'''
+    if is_binary(file_handle, WORDS_MAGIC):
+        return read_strings(file_handle, decode), read_array(file_handle)
+    data = load(file_handle)
+    words = data['words']
+    if not decode:
+        words = [word.encode('utf8') for word in words]
+    return words, np.array(data['df'], dtype = index_dtype)
+
+def load_words(file_handle, decode = True):
+    '''Reads a list of words from a binary or JSON word file.'''
+    return load_word_df(file_handle, decode)[0]
+
+def copy_data(source, destination, size, block_size = 2**20):
+    '''Copies size bytes from one open file to another, a block at a time.'''
+    while size > 0:
+        block = source.read(min(size, block_size))
+        if not block:
+            raise IOError("File ended %d bytes early" % size)
+        destination.write(block)
+        size -= len(block)
+
+def dump_word_parts(sources, file_handle):
+    '''Writes a binary word file of the words in several parts, without
+    reading them into memory. Each source is an open file at a table of
+    words written by write_strings, followed by their frequencies written by
+    write_array.'''
+    parts = []
+    for source in sources:
+        n, size = np.frombuffer(source.read(16), dtype = '<u8')
+        #Empty parts are skipped, as they'd add a separator
+        if n:
+            parts.append((int(n), int(size), source.tell(), source))
+    n = sum(part[0] for part in parts)
+    size = sum(part[1] for part in parts) + max(len(parts)-1, 0)
+    file_handle.write(WORDS_MAGIC)
+    file_handle.write(np.array([n, size], dtype = '<u8').tobytes())
+    for i, (n_part, size_part, position, source) in enumerate(parts):
+        if i:
+            file_handle.write('\x00')
+        source.seek(position)
+        copy_data(source, file_handle, size_part)
+    file_handle.write(np.array([n], dtype = '<u8').tobytes())
+    for n_part, size_part, position, source in parts:
+        source.seek(position + size_part + 8)
+        copy_data(source, file_handle, n_part*index_dtype.itemsize)
+
+def dump_links(linkhash, file_handle, format = None):
+    '''Writes a link hash like {target : set([sources])} in the intermediate
+    format (or format, if given). In binary, this is a table of the titles
+    involved and arrays of the indices of targets, their number of sources
+    and the sources themselves.'''
+    if (format or intermediate_format) == 'json':
+        dump(linkhash, file_handle)
+        return None
+    titles = {}
+    targets, n_sources, sources = [], [], []
+    for target, target_sources in linkhash.iteritems():
+        targets.append(titles.setdefault(target, len(titles)))
+        n_sources.append(len(target_sources))
+        for source in target_sources:
+            sources.append(titles.setdefault(source, len(titles)))
+    table = sorted(titles, key = titles.get)
+    file_handle.write(LINKS_MAGIC)
+    write_strings(table, file_handle)
+    write_array(targets, file_handle)
+    write_array(n_sources, file_handle)
+    write_array(sources, file_handle)
+
+def iter_links(file_handle):
+    '''Generates (target, list of sources) pairs from a binary or JSON link
+    file.'''
+    if not is_binary(file_handle, LINKS_MAGIC):
+        for target, sources in load(file_handle).iteritems():
+            yield target, sources
+        return
+    table = read_strings(file_handle)
+    targets = read_array(file_handle).tolist()
+    n_sources = read_array(file_handle).tolist()
+    sources = [table[i] for i in read_array(file_handle).tolist()]
+    start = 0
+    for target, n in zip(targets, n_sources):
+        yield table[target], sources[start:start+n]
+        start += n
+
+def dump_counts(articles, file_handle, format = None):
+    '''Writes word counts of articles, given as a dict like
+    {title : (word ids, counts)}. Word ids index the word file written along
+    with the counts. In binary, this is a table of titles followed by arrays
+    of the number of distinct words in each article, the word ids and the
+    counts.'''
+    titles = list(articles)
+    if (format or intermediate_format) == 'json':
+        as_json = {}
+        for title in titles:
+            word_ids, counts = articles[title]
+            as_json[title] = {'word_ids' : np.asarray(word_ids).tolist(),
+                              'counts' : np.asarray(counts).tolist()}
+        dump(as_json, file_handle)
+        return None
+    file_handle.write(COUNTS_MAGIC)
+    write_strings(titles, file_handle)
+    write_array([len(articles[title][0]) for title in titles], file_handle)
+    write_array(np.concatenate([articles[title][0] for title in titles] +
+                               [[]]), file_handle)
+    write_array(np.concatenate([articles[title][1] for title in titles] +
+                               [[]]), file_handle)
+
+def load_counts(file_handle):
+    '''Reads a binary or JSON count file. Returns the article titles and
+    arrays of their number of distinct words, word ids and counts.'''
+    if is_binary(file_handle, COUNTS_MAGIC):
+        titles = read_strings(file_handle)
+        lengths = read_array(file_handle)
+        word_ids = read_array(file_handle)
+        counts = read_array(file_handle)
+        return titles, lengths, word_ids, counts
+    articles = load(file_handle)
+    titles = list(articles)
+    entries = [articles[title] for title in titles]
+    lengths = np.array([len(e['word_ids']) for e in entries],
+                       dtype = index_dtype)
+    word_ids = np.array([i for e in entries for i in e['word_ids']],
+                        dtype = index_dtype)
+    counts = np.array([n for e in entries for n in e['counts']],
+                      dtype = index_dtype)
+    return titles, lengths, word_ids, counts
+
+def dump_redirects(redirects, file_handle, format = None):
+    '''Writes redirects like {redirect title : target title} in the
+    intermediate format (or format, if given). In binary, this is a table of
+    the titles involved and arrays of the indices of redirects and targets.'''
+    if (format or intermediate_format) == 'json':
+        dump(redirects, file_handle)
+        return None
+    titles = {}
+    sources, targets = [], []
+    for source, target in redirects.iteritems():
+        sources.append(titles.setdefault(source, len(titles)))
+        targets.append(titles.setdefault(target, len(titles)))
+    file_handle.write(REDIRECTS_MAGIC)
+    write_strings(sorted(titles, key = titles.get), file_handle)
+    write_array(sources, file_handle)
+    write_array(targets, file_handle)
+
+def load_redirects(file_handle):
+    '''Reads a binary or JSON redirect file into a dict.'''
+    if not is_binary(file_handle, REDIRECTS_MAGIC):
+        return load(file_handle)
+    table = read_strings(file_handle)
+    sources = read_array(file_handle).tolist()
+    targets = read_array(file_handle).tolist()
+    return {table[s] : table[t] for s, t in zip(sources, targets)}
+
+def dump_pages(pages, file_handle, format = None):
+    '''Writes page hashes like {title : sha1} in the intermediate format (or
+    format, if given). In binary, this is a table of titles followed by a
+    table of the hashes.'''
+    if (format or intermediate_format) == 'json':
+        dump(pages, file_handle)
+        return None
+    titles = list(pages)
+    file_handle.write(PAGES_MAGIC)
+    write_strings(titles, file_handle)
+    write_strings([pages[title] for title in titles], file_handle)
+
+def load_pages(file_handle):
+    '''Reads a binary or JSON page hash file into a dict.'''
+    if not is_binary(file_handle, PAGES_MAGIC):
+        return load(file_handle)
+    titles = read_strings(file_handle)
+    return dict(zip(titles, read_strings(file_handle)))
+
+#==============================================================================
+# Index files map each word or concept to its row or column in the matrix.
+# In binary, the strings are stored in index order with an array of their
+# offsets, followed by the indices sorted by string, so an index file can be
+# memory mapped instead of loaded: strings are found by binary search, and
+# the string of an index is read directly.
+#==============================================================================
+
+def dump_index(indices, file_handle, format = None):
+    '''Writes a map of strings to the indices 0...n-1, like {word : index},
+    in the intermediate format (or format, if given). The file must be
+    opened in binary mode.'''
+    if (format or intermediate_format) == 'json':
+        dump(indices, file_handle)
+        return None
+    strings = [None]*len(indices)
+    for string, i in indices.iteritems():
+        strings[i] = string.encode('utf8')
+    offsets = np.zeros(len(strings)+1, dtype = '<u8')
+    offsets[1:] = np.cumsum([len(string) for string in strings])
+    order = sorted(xrange(len(strings)), key = strings.__getitem__)
+    file_handle.write(INDEX_MAGIC)
+    file_handle.write(np.array([len(strings), offsets[-1]],
+                               dtype = '<u8').tobytes())
+    file_handle.write(offsets.tobytes())
+    file_handle.write(np.array(order, dtype = index_dtype).tobytes())
+    file_handle.write(''.join(strings))
+
+def dump_index_parts(parts, file_handle):
+    '''Writes a binary index file of strings which are in sorted order,
+    and are indexed in that order, without reading them into memory. The
+    strings come in parts of (lengths, source), where source is an open file
+    at the UTF-8 encoded strings of the part, concatenated, and lengths is
+    an array of their lengths in bytes.'''
+    sizes = [int(np.sum(lengths)) for lengths, source in parts]
+    n = sum(len(lengths) for lengths, source in parts)
+    file_handle.write(INDEX_MAGIC)
+    file_handle.write(np.array([n, sum(sizes)], dtype = '<u8').tobytes())
+    file_handle.write(np.zeros(1, dtype = '<u8').tobytes())
+    base = 0
+    for (lengths, source), size in zip(parts, sizes):
+        offsets = base + np.cumsum(lengths, dtype = '<u8')
+        file_handle.write(offsets.astype('<u8').tobytes())
+        base += size
+    file_handle.write(np.arange(n, dtype = index_dtype).tobytes())
+    for (lengths, source), size in zip(parts, sizes):
+        copy_data(source, file_handle, size)
+
+def load_index(filename):
+    '''Opens an index file as a StringIndex. Binary files are memory mapped,
+    while JSON ones are read into memory.'''
+    with open(filename, 'rb') as f:
+        if is_binary(f, INDEX_MAGIC):
+            return StringIndex(mmap.mmap(f.fileno(), 0,
+                                         access = mmap.ACCESS_READ))
+        indices = load(f)
+    data = io.BytesIO()
+    dump_index(indices, data, 'binary')
+    return StringIndex(data.getvalue())
+
+class StringIndex(collections.Mapping):
+    '''Read-only dict-like map of strings to their indices, read from a
+    buffer holding a binary index file, e.g. a memory map. Looking up a
+    string takes a binary search, while string(i) returns the string of
+    index i in constant time. Strings are unicode, but UTF-8 encoded str
+    keys can be looked up too.
+    Every fence_step'th string in sorted order is kept in memory, so most of
+    the search is done by bisect in C.'''
+    
+    fence_step = 32
+    offset_pair = struct.Struct('<QQ')  #Faster than numpy for single items
+    
+    def __init__(self, data):
+        self.data = data
+        position = len(INDEX_MAGIC)
+        self.n, size = [int(x) for x in np.frombuffer(data, dtype = '<u8',
+                                                      count = 2,
+                                                      offset = position)]
+        position += 16
+        self.offsets_start = position
+        position += 8*(self.n+1)
+        self.order = np.frombuffer(data, dtype = index_dtype, count = self.n,
+                                   offset = position)
+        self.start = position + index_dtype.itemsize*self.n
+        self.end = self.start + size  #Where any data following it starts
+        self.fence = [self.encoded(i)
+                      for i in self.order[::self.fence_step].tolist()]
+    
+    def encoded(self, i):
+        '''Returns the UTF-8 encoded string of index i.'''
+        start, end = self.offset_pair.unpack_from(self.data,
+                                                  self.offsets_start + 8*i)
+        return self.data[self.start+start : self.start+end]
+    
+    def string(self, i):
+        '''Returns the string of index i.'''
+        return self.encoded(i).decode('utf8')
+    
+    def __getitem__(self, string):
+        if isinstance(string, unicode):
+            key = string.encode('utf8')
+        else:
+            key = string
+        #Find the first position in the sorted order not before key, which
+        #is between the fence posts around key
+        post = bisect.bisect_left(self.fence, key)
+        lo = max(post-1, 0)*self.fence_step
+        hi = min(post*self.fence_step, self.n)
+        #Same as comparing self.encoded(self.order[mid]) with key, inlined
+        data, start, order = self.data, self.start, self.order
+        unpack, offsets = self.offset_pair.unpack_from, self.offsets_start
+        while lo < hi:
+            mid = (lo+hi)//2
+            a, b = unpack(data, offsets + 8*int(order[mid]))
+            if data[start+a : start+b] < key:
+                lo = mid+1
+            else:
+                hi = mid
+        if lo < self.n:
+            i = int(self.order[lo])
+            if self.encoded(i) == key:
+                return i
+        raise KeyError(string)
+    
+    def __len__(self):
+        return self.n
+    
+    def __iter__(self):
+        '''Strings in index order.'''
+        for i in xrange(self.n):
+            yield self.string(i)
+    
+    #Pairs are generated in index order, avoiding a search for each string
+    def iteritems(self):
+        for i in xrange(self.n):
+            yield self.string(i), i
+    
+    def items(self):
+        return list(self.iteritems())
+    
+    def itervalues(self):
+        return iter(xrange(self.n))
+    
+    def values(self):
+        return range(self.n)
+
+#==============================================================================
+# The pages of a build are saved with their sha1 and what became of them, so
+# the next build can skip unchanged ones. In binary, this is an index file of
+# the titles followed by arrays of the hashes and statuses, so parse processes
+# can share a memory map of it instead of each loading it.
+#==============================================================================
+
+page_statuses = ['concept', 'rejected']
+sha1_dtype = np.dtype('S40')  #Hex digests, or base 36 ones from the dump
+
+def dump_page_status(pages, file_handle, format = None):
+    '''Writes the sha1 of the pages of a build, like
+    {status : {title : sha1}}, in the intermediate format (or format, if
+    given). The file must be opened in binary mode.'''
+    if (format or intermediate_format) == 'json':
+        dump(pages, file_handle)
+        return None
+    titles = []
+    sha1s = []
+    statuses = []
+    for code, status in enumerate(page_statuses):
+        hashes = pages.get(status, {})
+        titles.extend(hashes)
+        sha1s.extend(hashes.itervalues())
+        statuses.extend([code]*len(hashes))
+    dump_index({title : i for i, title in enumerate(titles)}, file_handle,
+               'binary')
+    file_handle.write(np.array(sha1s, dtype = sha1_dtype).tobytes())
+    file_handle.write(np.array(statuses, dtype = np.uint8).tobytes())
+
+def load_page_status(filename):
+    '''Opens a page status file as a PageStatus. Binary files are memory
+    mapped, while JSON ones are read into memory.'''
+    with open(filename, 'rb') as f:
+        if is_binary(f, INDEX_MAGIC):
+            return PageStatus(mmap.mmap(f.fileno(), 0,
+                                        access = mmap.ACCESS_READ))
+        pages = load(f)
+    data = io.BytesIO()
+    dump_page_status(pages, data, 'binary')
+    return PageStatus(data.getvalue())
+
+class PageStatus(collections.Mapping):
+    '''Read-only dict-like map of the titles of a build's pages to their
+    (sha1, status), read from a buffer holding a binary page status file.
+    Titles are found by binary search, like in a StringIndex.'''
+    
+    def __init__(self, data):
+        self.titles = StringIndex(data)
+        n = len(self.titles)
+        self.sha1s = np.frombuffer(data, dtype = sha1_dtype, count = n,
+                                   offset = self.titles.end)
+        self.statuses = np.frombuffer(data, dtype = np.uint8, count = n,
+                                      offset = self.titles.end +
+                                      sha1_dtype.itemsize*n)
+    
+    def __getitem__(self, title):
+        i = self.titles[title]
+        return str(self.sha1s[i]), page_statuses[self.statuses[i]]
+    
+    def __len__(self):
+        return len(self.titles)
+    
+    def __iter__(self):
+        return iter(self.titles)
+
 if __name__ == '__main__':
     print pushme()
\ No newline at end of file
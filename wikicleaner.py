@@ -13,7 +13,9 @@ def dropNested(text, openDelim, closeDelim):
     '''Helper function to match nested expressions which may cause problems
     example: {{something something {{something else}} and something third}}
     cannot be easily matched with a regexp to remove all occurrences.
-    Copied from the WikiExtractor project.'''
+    The delimiters are regexps, or compiled patterns. The text is scanned
+    once, as each search starts where the last one of its kind ended.
+    Adapted from the WikiExtractor project.'''
     openRE = re.compile(openDelim)
     closeRE = re.compile(closeDelim)
     # partition text in separate blocks { } { }
@@ -60,13 +62,7 @@ def dropNested(text, openDelim, closeDelim):
             # { { }
             nest += 1
     # collect text outside partitions
-    res = ''
-    start = 0
-    for s, e in  matches:
-        res += text[start:s]
-        start = e
-    res += text[start:]
-    return res
+    return drop_spans(matches, text)
 
 def unescape(text):
     '''Removes HTML or XML character references and entities
@@ -92,15 +88,22 @@ def unescape(text):
 def drop_spans(matches, text):
     """Drop from text the blocks identified in matches"""
     matches.sort()
-    res = ''
+    #Join the pieces at the end, as adding to a unicode string copies it
+    res = []
     start = 0
     for s, e in  matches:
-        res += text[start:s]
+        res.append(text[start:s])
         start = e
-    res += text[start:]
-    return res
+    res.append(text[start:])
+    return ''.join(res)
 
 ###Compile regexps for text cleanup:
+#Delimiters of templates and tables
+template_open = re.compile(r'{{')
+template_close = re.compile(r'}}')
+table_open = re.compile(r'{\|')
+table_close = re.compile(r'\|}')
+
 #Construct patterns for elements to be discarded:
 discard_elements = set([
         'gallery', 'timeline', 'noinclude', 'pre',
@@ -110,9 +113,11 @@ discard_elements = set([
         'ref', 'references', 'img', 'imagemap', 'source'
         ])
 discard_element_patterns = []
+discard_element_tags = []  #Tag of each pattern
 for tag in discard_elements:
     pattern = re.compile(r'<\s*%s\b[^>]*>.*?<\s*/\s*%s>' % (tag, tag), re.DOTALL | re.IGNORECASE)
     discard_element_patterns.append(pattern)
+    discard_element_tags.append(tag)
 
 #Construct patterns to recognize HTML tags
 selfclosing_tags = set([ 'br', 'hr', 'nobr', 'ref', 'references' ])
@@ -134,12 +139,24 @@ for tag in ignored_tags:
     right = re.compile(r'<\s*/\s*%s>' % tag, re.IGNORECASE)
     ignored_tag_patterns.append((left, right))
 
+#Lookup table of the patterns matching spans to drop for each tag
+span_patterns = {}
+for tag, pattern in zip(selfclosing_tags, selfclosing_tag_patterns):
+    span_patterns.setdefault(tag, []).append(pattern)
+for tag, patterns in zip(ignored_tags, ignored_tag_patterns):
+    span_patterns.setdefault(tag, []).extend(patterns)
+
 #Construct patterns to recognize math and code
 placeholder_tags = {'math':'formula', 'code':'codice'}
 placeholder_tag_patterns = []
+placeholder_openings = []  #Opening tag of each pattern, with the tag name
 for tag, repl in placeholder_tags.items():
     pattern = re.compile(r'<\s*%s(\s*| [^>]+?)>.*?<\s*/\s*%s\s*>' % (tag, tag), re.DOTALL | re.IGNORECASE)
     placeholder_tag_patterns.append((pattern, repl))
+    placeholder_openings.append((tag, re.compile(r'<\s*%s' % tag, re.IGNORECASE)))
+
+#Names of opening and closing tags
+tag_name = re.compile(r'<\s*/?\s*(\w+)')
 
 #HTML comments
 comment = re.compile(r'<!--.*?-->', re.DOTALL)
@@ -188,39 +205,10 @@ def make_anchor_tag(match):
     anchor += trail
     return anchor
 
-def clean(text):
-    '''Outputs an article in plaintext from its format in the raw xml dump.'''        
-    # Drop transclusions (template, parser functions)
-    # See: http://www.mediawiki.org/wiki/Help:Templates
-    text = dropNested(text, r'{{', r'}}')
-    # Drop tables
-    text = dropNested(text, r'{\|', r'\|}')
-    
-    # Convert wikilinks links to plaintext
-    text = wiki_link.sub(make_anchor_tag, text)
-    # Drop remaining links
-    text = parametrized_link.sub('', text)
-    
-    # Handle external links
-    text = externalLink.sub(r'\1', text)
-    text = externalLinkNoAnchor.sub('', text)
-    
-    #Handle text formatting
-    text = bold_italic.sub(r'\1', text)
-    text = bold.sub(r'\1', text)
-    text = italic_quote.sub(r'&quot;\1&quot;', text)
-    text = italic.sub(r'&quot;\1&quot;', text)
-    text = quote_quote.sub(r'\1', text)
-    text = text.replace("'''", '').replace("''", '&quot;')
-    
-    ################ Process HTML ###############    
-    
-    # turn into HTML
-    text = unescape(text)
-    
-    # do it again (&amp;nbsp;)    
-    text = unescape(text)
-    
+def strip_html(text):
+    '''Drops HTML comments, tags and the elements in discard_elements from
+    text, and replaces math and code with placeholders. Every pattern is run
+    over the whole text.'''
     # Collect spans
 
     matches = []
@@ -254,10 +242,114 @@ def clean(text):
         for match in pattern.finditer(text):
             text = text.replace(match.group(), '%s_%d' % (placeholder, index))
             index += 1
+    return text
+
+def tag_names(text):
+    '''Returns the set of names of the tags in text, in lower case.'''
+    return set(name.lower() for name in tag_name.findall(text))
+
+def expand_placeholders(text, pattern, placeholder, opening):
+    '''Replaces each match of pattern with placeholder_<n>, where n counts
+    the matches, like strip_html does. There, every copy of a match is
+    replaced at once, so copies keep the number of the first. That is
+    done in one pass here, unless an element contains another opening tag
+    and so may overlap copies of other elements.'''
+    matches = list(pattern.finditer(text))
+    if any(opening.search(m.group(), 1) for m in matches):
+        index = 1
+        for match in matches:
+            text = text.replace(match.group(), '%s_%d' % (placeholder, index))
+            index += 1
+        return text
+    res = []
+    start = 0
+    numbered = {}
+    for index, match in enumerate(matches, 1):
+        res.append(text[start:match.start()])
+        res.append(numbered.setdefault(match.group(),
+                                       '%s_%d' % (placeholder, index)))
+        start = match.end()
+    res.append(text[start:])
+    return ''.join(res)
+
+def strip_html_scan(text):
+    '''Gives the same result as strip_html, but first finds the names of the
+    tags in text in a single scan. Only the patterns of those tags are run,
+    which are looked up in tables, and the names are found again only when
+    the text changes.'''
+    names = tag_names(text)
+    
+    # Collect spans of comments, self-closing and ignored tags
+    matches = []
+    if '<!--' in text:
+        for m in comment.finditer(text):
+            matches.append((m.start(), m.end()))
+    for name in names:
+        for pattern in span_patterns.get(name, ()):
+            for m in pattern.finditer(text):
+                matches.append((m.start(), m.end()))
+    if matches:
+        text = drop_spans(matches, text)
+        names = tag_names(text)
+    
+    # Drop discarded elements, in the same order as strip_html
+    for tag, pattern in zip(discard_element_tags, discard_element_patterns):
+        if tag in names:
+            text, n = pattern.subn('', text)
+            if n:
+                names = tag_names(text)
+    
+    # Expand placeholders
+    for (pattern, placeholder), (tag, opening) in zip(placeholder_tag_patterns,
+                                                      placeholder_openings):
+        if tag in names:
+            text = expand_placeholders(text, pattern, placeholder, opening)
+            names = tag_names(text)
+    return text
+
+#Ways of processing HTML. Both give the same result.
+html_engines = {'patterns' : strip_html,
+                'scan' : strip_html_scan}
+
+def drop_templates(text):
+    '''Drops transclusions (templates, parser functions) and tables.'''
+    # See: http://www.mediawiki.org/wiki/Help:Templates
+    text = dropNested(text, template_open, template_close)
+    # Drop tables
+    return dropNested(text, table_open, table_close)
+
+def convert_links(text):
+    '''Converts wikilinks to plaintext and drops other links.'''
+    text = wiki_link.sub(make_anchor_tag, text)
+    # Drop remaining links
+    text = parametrized_link.sub('', text)
+    
+    # Handle external links
+    text = externalLink.sub(r'\1', text)
+    return externalLinkNoAnchor.sub('', text)
+
+def strip_formatting(text):
+    '''Removes bold and italic markup, marking italics as quotes.'''
+    text = bold_italic.sub(r'\1', text)
+    text = bold.sub(r'\1', text)
+    text = italic_quote.sub(r'&quot;\1&quot;', text)
+    text = italic.sub(r'&quot;\1&quot;', text)
+    text = quote_quote.sub(r'\1', text)
+    return text.replace("'''", '').replace("''", '&quot;')
+
+def process_html(text, engine = 'scan'):
+    '''Unescapes HTML and drops comments, tags and discarded elements, then
+    expands placeholders, using the given engine from html_engines.'''
+    # turn into HTML
+    text = unescape(text)
     
-    #############################################
+    # do it again (&amp;nbsp;)    
+    text = unescape(text)
     
-    # Drop preformatted
+    return html_engines[engine](text)
+
+def tidy(text):
+    '''Drops preformatted text and cleans up whitespace and punctuation.'''
     # This can't be done before since it may remove tags
     text = preformatted.sub('', text)
 
@@ -268,9 +360,10 @@ def clean(text):
     text = re.sub(u' (,:\.\)\]»)', r'\1', text)
     text = re.sub(u'(\[\(«) ', r'\1', text)
     text = re.sub(r'\n\W+?\n', '\n', text) # lines with only punctuations
-    text = text.replace(',,', ',').replace(',.', '.')    
-    
-    #Handle section headers, residua etc.
+    return text.replace(',,', ',').replace(',.', '.')    
+
+def join_lines(text):
+    '''Joins the relevant lines, handling section headers, residua etc.'''
     page = []
     headers = {}
     empty_section = False
@@ -320,11 +413,33 @@ def clean(text):
         elif not empty_section:
             page.append(line)    
     
-    text = ''.join(page)
+    return ''.join(page)
 
-    #Remove quote tags.
+def strip_punctuation(text):
+    '''Removes quote tags, parentheses, punctuation and the like.'''
     text = text.replace("&quot;", '')
+    return re.sub('[^\w\s\d\'\-]','', text)
+
+def clean_stages(text, engine = 'scan'):
+    '''Cleans an article like clean, generating the name of each stage and
+    the text after it, so the time spent in each stage can be measured.'''
+    text = drop_templates(text)
+    yield 'templates', text
+    text = convert_links(text)
+    yield 'links', text
+    text = strip_formatting(text)
+    yield 'formatting', text
+    text = process_html(text, engine)
+    yield 'html', text
+    text = tidy(text)
+    yield 'tidy', text
+    text = join_lines(text)
+    yield 'lines', text
+    yield 'punctuation', strip_punctuation(text)
 
-    #Get rid of parentheses, punctuation and the like    
-    text = re.sub('[^\w\s\d\'\-]','', text)
-    return text
\ No newline at end of file
+def clean(text, engine = 'scan'):
+    '''Outputs an article in plaintext from its format in the raw xml dump.
+    engine is the method used to process HTML, see html_engines.'''        
+    for stage, text in clean_stages(text, engine):
+        pass
+    return text
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+'''Extraction of links between articles from raw wikitext.
+Links look like [[title]], [[title|display text]] or [[title#section]].
+Links into namespaces, e.g. [[file:something.png]], are ignored, and the
+targets of the remaining links are converted to canonical article titles.'''
+
+import re
+import wikicleaner
+
+whitespace = re.compile(r'[\s_]+')
+forbidden_chars = re.compile('[?/\\\*\"\']')
+
+def canonize_title(title):
+    # remove leading whitespace and underscores
+    title = title.strip(' _')
+    # replace sequences of whitespace and underscore chars with a single space
+    title = whitespace.sub(' ', title)
+    #remove forbidden characters
+    title = forbidden_chars.sub('', title)
+    return title.title()
+
+def lru_cache(maxsize):
+    '''Decorator which memoizes a function of a single hashable argument,
+    keeping the maxsize most recently used results. Works like
+    functools.lru_cache in Python 3: entries live in a circular doubly
+    linked list, which is reordered on every hit.
+    The decorated function gets a cache_info method returning
+    (hits, misses, current size).'''
+    PREV, NEXT, KEY, RESULT = 0, 1, 2, 3
+
+    def decorator(function):
+        cache = {}
+        root = []  #Sentinel. root[NEXT] is the least recently used entry
+        root[:] = [root, root, None, None]
+        #Lists, so the closure can update them
+        state = [root]
+        stats = [0, 0]
+
+        def wrapper(key):
+            link = cache.get(key)
+            if link is not None:
+                #Move entry to the most recently used end of the list
+                link_prev, link_next, _, result = link
+                link_prev[NEXT] = link_next
+                link_next[PREV] = link_prev
+                root = state[0]
+                last = root[PREV]
+                last[NEXT] = root[PREV] = link
+                link[PREV] = last
+                link[NEXT] = root
+                stats[0] += 1
+                return result
+
+            result = function(key)
+            stats[1] += 1
+            root = state[0]
+            if len(cache) >= maxsize:
+                #Reuse the old root for the new entry and make the least
+                #recently used entry the new root.
+                root[KEY] = key
+                root[RESULT] = result
+                cache[key] = root
+                root = state[0] = root[NEXT]
+                del cache[root[KEY]]
+                root[KEY] = root[RESULT] = None
+            else:
+                last = root[PREV]
+                link = [last, root, key, result]
+                last[NEXT] = root[PREV] = cache[key] = link
+            return result
+
+        wrapper.cache_info = lambda: (stats[0], stats[1], len(cache))
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+class LinkExtractor(object):
+    '''Finds the canonical titles of the articles a page links to.
+    The page is scanned once with a precompiled regexp, namespaces are
+    recognized with a set lookup at each colon, and canonical titles are
+    kept in an LRU cache, as the same titles are linked to over and over.'''
+
+    link_regexp = re.compile(r'\[\[(.*?)\]')  #grap stuff like [[<something>]]
+    title_regexp = re.compile(r'[^\|\#]*')
+
+    def __init__(self, namespaces = wikicleaner.namespaces,
+                 cache_size = 10**5):
+        self.namespaces = frozenset(namespaces)
+        #Lengths of namespace names to look for in front of each colon
+        self.lengths = sorted(set(len(ns) for ns in namespaces))
+        self.canonize = lru_cache(cache_size)(canonize_title)
+
+    def in_namespace(self, link):
+        '''Checks if link contains '<namespace>:' anywhere,
+        e.g. 'file:something.png'.'''
+        colon = link.find(':')
+        while colon >= 0:
+            for length in self.lengths:
+                if length > colon:
+                    break
+                if link[colon-length:colon] in self.namespaces:
+                    return True
+            colon = link.find(':', colon+1)
+        return False
+
+    def canonical(self, title):
+        '''Returns title the way it appears among the targets found by
+        extract, or None if it's in a namespace.'''
+        link = title.lower()
+        if ':' in link:
+            if self.in_namespace(link):
+                return None
+            link = link.replace(':', '')
+        return self.canonize(self.title_regexp.match(link).group(0))
+    
+    def extract(self, text):
+        '''Returns a list of the titles linked to in text, in order of
+        appearance. text is expected to be in lower case.'''
+        links = []
+        for link in self.link_regexp.findall(text):
+            #Skip links to files, categories and the like
+            if ':' in link:
+                if self.in_namespace(link):
+                    continue
+                #Namespaces done, so remove any colons:
+                link = link.replace(':', '')
+            if not link:
+                continue  #Some noob could've written an empty link...
+            #remove chapter designations/displaytext - keep article title
+            raw = self.title_regexp.match(link).group(0)
+            links.append(self.canonize(raw))
+        return links
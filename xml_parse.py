@@ -18,44 +18,291 @@ The file structure is like {'word blah' : index blah}'''
 import re
 import xml.sax as SAX
 import wikicleaner
+import wikilinks
+from wikilinks import LinkExtractor
+from pagecache import PageCache, page_key, code_version
 import os
 import glob
 import shared
 import sys
+import multiprocessing
+from collections import deque, Counter
+import bz2
+import zlib
+import threading
+import Queue
+import bisect
+import argparse
+from xml.parsers import expat
+import numpy as np
+import json
+import hashlib
 
 DEFAULT_FILENAME = 'medium_wiki.xml'
 
-def canonize_title(title):
-  # remove leading whitespace and underscores
-    title = title.strip(' _')
-  # replace sequencesences of whitespace and underscore chars with a single space
-    title = re.compile(r'[\s_]+').sub(' ', title)
-    #remove forbidden characters
-    title = re.sub('[?/\\\*\"\']','',title)
-    return title.title()
-
 #Import shared parameters
 from shared import extensions, temp_dir
 
-#Cleanup
-for ext in extensions.values():
-    for f in glob.glob(temp_dir + '*'+ext):
-        os.remove(f)
+#Progress of the parser, recorded each time files are written
+CHECKPOINT_FILE = temp_dir + 'checkpoint.json'
+
+def cleanup():
+    '''Removes output files from previous runs.
+    This is not done at import time, as worker processes might import this
+    module while the parser is running.'''
+    for ext in extensions.values():
+        for f in glob.glob(temp_dir + '*'+ext):
+            os.remove(f)
+    for f in (CHECKPOINT_FILE, shared.update_file):
+        if os.path.exists(f):
+            os.remove(f)
 
-def filename_generator(folder):
+def remove_uncommitted(files_written):
+    '''Removes output files numbered files_written or above, which may have
+    been partially written after the last checkpoint.'''
+    for f in glob.glob(temp_dir + 'content*'):
+        number = re.match(r'content(\d+)\.', os.path.basename(f))
+        if number and int(number.group(1)) >= files_written:
+            os.remove(f)
+
+def filename_generator(folder, prefix = "content", count = 0):
     '''Generator for output filenames'''
     if not os.path.exists(folder):
         os.makedirs(folder)
-    count = 0
     while True:
-        filename = folder+"content"+str(count)
+        filename = folder+prefix+str(count)
         count += 1
         yield filename
 
 make_filename = filename_generator(temp_dir)
 
-#Format {right title : redirected title}, e.g. {because : ([cuz, cus])}
-redirects = {}
+class DecompressingReader(object):
+    '''Read-only file-like object which decompresses a .bz2 or .gz file on
+    the fly. Decompression runs in a separate thread (bz2 and zlib release
+    the GIL while decompressing), so it overlaps with parsing. Concatenated
+    streams, like those in multistream dumps, are handled.
+    If start and end are given, only that byte range of the compressed file
+    is read. It must begin and end at stream boundaries.'''
+    
+    block_size = 2**20  #Compressed bytes read at a time
+    max_blocks = 16  #Decompressed blocks allowed to wait for the parser
+    
+    def __init__(self, filename, start = 0, end = None):
+        if filename.endswith('.bz2'):
+            self.make_decompressor = bz2.BZ2Decompressor
+        elif filename.endswith('.gz'):
+            self.make_decompressor = lambda: zlib.decompressobj(
+                                                        16+zlib.MAX_WBITS)
+        else:
+            raise ValueError("Can't decompress %s" % filename)
+        self.name = filename
+        self.file = open(filename, 'rb')
+        self.file.seek(start)
+        #Number of compressed bytes left to read. None means until EOF
+        self.remaining = None if end is None else end - start
+        self.blocks = Queue.Queue(self.max_blocks)
+        #Block currently being read and position within it
+        self.block = ''
+        self.position = 0
+        self.done = False
+        self.thread = threading.Thread(target = self.decompress)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def decompress(self):
+        '''Runs in the decompression thread. Puts decompressed blocks in the
+        queue followed by None at EOF, or the exception if one is raised.'''
+        try:
+            decompressor = self.make_decompressor()
+            while True:
+                if self.remaining is None:
+                    data = self.file.read(self.block_size)
+                else:
+                    data = self.file.read(min(self.block_size,
+                                              self.remaining))
+                    self.remaining -= len(data)
+                if not data:
+                    break
+                while data:
+                    self.blocks.put(decompressor.decompress(data))
+                    #Leftover data belongs to the next stream
+                    data = decompressor.unused_data
+                    if data:
+                        decompressor = self.make_decompressor()
+            self.blocks.put(None)
+        except Exception as e:
+            self.blocks.put(e)
+    
+    def read(self, size = -1):
+        '''Returns up to size decompressed bytes - everything if size < 0.'''
+        pieces = []
+        while size != 0:
+            #Grab a new block from the queue when the current one is used up
+            if self.position >= len(self.block):
+                if self.done:
+                    break
+                block = self.blocks.get()
+                if block is None or isinstance(block, Exception):
+                    self.done = True
+                    if block is not None:
+                        raise block
+                    continue
+                self.block, self.position = block, 0
+            if size < 0:
+                piece = self.block[self.position:]
+            else:
+                piece = self.block[self.position:self.position+size]
+                size -= len(piece)
+            self.position += len(piece)
+            pieces.append(piece)
+        return ''.join(pieces)
+    
+    def __iter__(self):
+        '''Generates the decompressed lines, a block at a time, so a large
+        file needn't be held in memory.'''
+        rest = ''
+        while True:
+            data = self.read(self.block_size)
+            if not data:
+                break
+            lines = (rest + data).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if rest:
+            yield rest
+    
+    def close(self):
+        self.file.close()
+
+class ShardReader(DecompressingReader):
+    '''Reads the pages in a byte range of a multistream dump, wrapped in a
+    mediawiki element so the range can be parsed on its own.
+    If end is None, the range runs to EOF, which holds the closing tag.'''
+    
+    def __init__(self, filename, start, end):
+        DecompressingReader.__init__(self, filename, start, end)
+        self.block = '<mediawiki>'
+        self.suffix = '' if end is None else '</mediawiki>'
+    
+    def read(self, size = -1):
+        data = DecompressingReader.read(self, size)
+        if not data and self.suffix:
+            if size < 0:
+                size = len(self.suffix)
+            data, self.suffix = self.suffix[:size], self.suffix[size:]
+        return data
+
+def read_multistream_index(filename):
+    '''Reads the index of a multistream dump, which has lines like
+    offset:page id:title. Returns the sorted offsets of the streams.
+    The index is read line by line, as it's large when decompressed.'''
+    offsets = []
+    last = None
+    index = open_dump(filename)
+    for line in index:
+        offset = line.split(':', 1)[0].strip()
+        #The pages of a stream are listed together
+        if offset and offset != last:
+            offsets.append(int(offset))
+            last = offset
+    index.close()
+    return sorted(set(offsets))
+
+def make_shards(offsets, n_shards, size):
+    '''Splits a multistream dump of the given size in bytes into at most
+    n_shards byte ranges of roughly equal size, given the stream offsets from
+    its index. Returns a list of (start, end) pairs. The last has end None.'''
+    first = offsets[0]
+    starts = [first]
+    for n in xrange(1, n_shards):
+        target = first + n*(size - first)//n_shards
+        #Move to the first stream starting at or after the target offset
+        i = bisect.bisect_left(offsets, target)
+        if i < len(offsets) and offsets[i] > starts[-1]:
+            starts.append(offsets[i])
+    return zip(starts, starts[1:] + [None])
+
+def parse_shard(args):
+    '''Parses a byte range of a multistream dump. Used by worker processes.
+    Each shard writes its own files, named like content<shard>_<count>.'''
+    filename, shard, start, end, engine, incremental, run = args
+    handler = WikiHandler(filename_generator(temp_dir,
+                                             "content%d_" % shard))
+    handler.verbose = True
+    if incremental:
+        handler.previous = load_previous()
+    handler.cache = open_cache(run)
+    parser = make_parser(engine)
+    parser.setContentHandler(handler)
+    reader = ShardReader(filename, start, end)
+    parser.parse(reader)
+    reader.close()
+    if handler.cache:
+        handler.cache.close()
+    return handler.article_counter
+
+def load_previous():
+    '''Returns the sha1 and status of the pages in the previous build, as a
+    shared.PageStatus. It's memory mapped, so shards parsed in parallel
+    share it.'''
+    return shared.load_page_status(shared.pages_file)
+
+def open_cache(run = None):
+    '''Opens the page cache set in shared.py, or returns None if there is
+    none. Entries made by other versions of the cleaning code are dropped.
+    A new run of the cache is started, unless the number of one is given.'''
+    if not shared.page_cache:
+        return None
+    return PageCache(shared.page_cache, shared.page_cache_size,
+                     code_version(wikicleaner, wikilinks), run)
+
+class PrefixedReader(object):
+    '''Wraps a file-like object, prepending prefix to its contents.'''
+    
+    def __init__(self, source, prefix):
+        self.source = source
+        self.prefix = prefix
+    
+    def read(self, size = -1):
+        if not self.prefix:
+            return self.source.read(size)
+        if size < 0:
+            data, self.prefix = self.prefix + self.source.read(), ''
+        else:
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+    
+    def close(self):
+        self.source.close()
+
+def open_dump(filename, offset = 0):
+    '''Opens an XML dump for parsing. Dumps ending in .bz2 or .gz are
+    decompressed as they are read, so they needn't be unpacked to disk.
+    If offset is given, reading starts at that (uncompressed) byte.'''
+    if filename.endswith('.bz2') or filename.endswith('.gz'):
+        dump = DecompressingReader(filename)
+        #Compressed streams can't seek, so decompress up to the offset
+        while offset > 0:
+            skipped = dump.read(min(offset, DecompressingReader.block_size))
+            if not skipped:
+                break
+            offset -= len(skipped)
+    else:
+        dump = open(filename, 'rb')
+        dump.seek(offset)
+    return dump
+
+def resume_dump(filename, offset):
+    '''Opens a dump for parsing from offset, which must be right after the
+    end of a page. The pages from there on are wrapped in a mediawiki
+    element, as the original root element is skipped.'''
+    end_tag = '</page>'
+    dump = open_dump(filename, offset - len(end_tag))
+    if dump.read(len(end_tag)) != end_tag:
+        raise ValueError("Offset %s in %s is not at the end of a page"
+                         % (offset, filename))
+    return PrefixedReader(dump, '<mediawiki>')
 
 #Minimum number of links/words required to keep an article.
 from shared import min_links_out, min_words
@@ -64,6 +311,59 @@ from shared import min_links_out, min_words
 logfile = open(os.path.basename(__file__)+'.log', 'w')
 log = shared.logmaker(logfile)
 
+#Finds outgoing links. Each worker process gets its own title cache.
+link_extractor = LinkExtractor(cache_size = shared.link_cache_size)
+
+def process_page(title, text, status = None, cached = None):
+    '''Converts the raw wikitext of a single article to plaintext and
+    extracts its outgoing links.
+    Returns a tuple (title, links, text, words), where words is None if the
+    article has too few outgoing links or words to be kept, and text is the
+    cleaned text, or None if the article wasn't cleaned. words is the set of
+    words in the text, or a Counter of them if token ids are used.
+    If the article is the same as in the previous build, status is what
+    became of it then, and only its links are extracted: 'rejected' articles
+    are discarded again, while text and words are False for a 'concept'.
+    If the page cache holds the article, cached is its (links, text) from
+    there, and the raw text isn't needed.
+    This only depends on its arguments, so it may run in a worker process.'''
+    if cached:
+        links, text = cached
+        if text is None:
+            return title, links, None, None
+    else:
+        text = text.lower()
+        
+        #Find and process link information
+        links = link_extractor.extract(text)
+        
+        #Text was cleaned in a previous build
+        if status == 'rejected':
+            return title, links, None, None
+        elif status == 'concept':
+            return title, links, False, False
+        
+        #Disregard current article if it contains too few links
+        if len(links) < min_links_out:
+            return title, links, None, None
+        
+        #Cleanup text
+        text = wikicleaner.clean(text, shared.clean_engine)
+    article_words = text.split()
+    
+    #Disregard article if it contains too few words
+    if len(article_words) < min_words:
+        return title, links, text, None
+    
+    if shared.token_ids:
+        return title, links, text, Counter(article_words)
+    return title, links, text, set(article_words)
+
+def process_batch(batch):
+    '''Processes a list of (title, text, status, cached) tuples. Used by
+    worker processes.'''
+    return [process_page(*page) for page in batch]
+
 class WikiHandler(SAX.ContentHandler):
     '''ContentHandler class to process XML and deal with the WikiText.
     It works basically like this:
@@ -75,21 +375,46 @@ class WikiHandler(SAX.ContentHandler):
     written to a file. The point of this approach is to 
     limit memory consumption.'''
     
-    def __init__(self):
+    def __init__(self, filename_maker = None):
         SAX.ContentHandler.__init__(self)
+        #Generator of output filenames. Defaults to the module-wide one
+        self.make_filename = filename_maker or make_filename
         self.current_data = None
         self.title = ''
+        self.title_buffer = []
         self.input_buffer = []
         self.output_buffer = {}
         self.article_counter = 0
-        self.links = []
         self.categories = []
         self.redirect = None
         self.verbose = False
-        #Harvest unique words here
-        self.words = set([])
+        #Harvest unique words here, with the number of articles using them
+        self.words = Counter()
+        #With token ids, words are numbered in order of appearance instead
+        #and articles stored like {title : (word ids, counts)}
+        self.word_ids = {}
+        self.counts_buffer = {}
         #keeps track of ingoing article links. format {to : set([from])}
         self.linkhash = {}
+        #Canonical titles of redirects, like {redirect : target}
+        self.redirects = {}
+        #sha1 of each page, like {title : sha1}. If previous holds those of
+        #the last build, as a shared.PageStatus, unchanged articles aren't
+        #cleaned again.
+        self.sha1_buffer = []
+        self.page_hashes = {}
+        self.previous = None
+        #Optional PageCache of cleaned articles, looked up by raw text
+        self.cache = None
+        #Progress info. If checkpoint_file is set, progress is saved there
+        #each time files are written. locate must then return the parser's
+        #current byte position in the dump.
+        self.checkpoint_file = None
+        self.dump_name = None
+        self.locate = None
+        self.files_written = 0
+        self.page_end = None  #Byte position after the last page collected
+        self.last_title = None
     
     def flush_input_buffer(self):
         '''Deletes info on the currently processed article.
@@ -97,15 +422,20 @@ class WikiHandler(SAX.ContentHandler):
         self.input_buffer = []
         self.current_data = None
         self.title = ''
-        self.links = []
+        self.title_buffer = []
+        self.sha1_buffer = []
         self.categories = []
         self.redirect = None
         
     def flush_output_buffer(self):
         '''Flushes data gathered so far to a file and resets.'''
         self.output_buffer = {}
-        self.words = set([])
+        self.words = Counter()
+        self.word_ids = {}
+        self.counts_buffer = {}
         self.linkhash = {}
+        self.redirects = {}
+        self.page_hashes = {}
     
     def startElement(self, tag, attrs):
         '''Eventhandler for element start - keeps track of current datatype.'''
@@ -114,24 +444,62 @@ class WikiHandler(SAX.ContentHandler):
         if tag == "redirect":
             self.redirect = attrs['title']
             return None
+        elif tag == "title":
+            self.title_buffer = []
     
     def endElement(self, name):
         '''Eventhandler for element end. This causes the parser to process
         its input buffer when a pageend is encountered.'''
         #Process content after each page
         if name == 'page':
+            if self.locate:
+                self.page_end = self.locate() + len('</page>')
             self.process()
+        #Titles may arrive in several pieces, e.g. split at entities
+        elif name == 'title':
+            self.title = ''.join(self.title_buffer)
         #Write remaining data at EOF.
         elif name == 'mediawiki':
-            self.writeout()
+            self.finish()
 
     def characters(self, content):
         '''Character event handler. This simply passes any raw text from an
         article field to the input buffer and updates title info.'''
         if self.current_data == 'text':
             self.input_buffer.append(content)
-        elif self.current_data == 'title' and not content.isspace():
-            self.title = content
+        elif self.current_data == 'title':
+            self.title_buffer.append(content)
+        elif self.current_data == 'sha1':
+            self.sha1_buffer.append(content)
+    
+    def check_unchanged(self, text):
+        '''Returns the sha1 of the current page and, if the page is the same
+        as in the previous build, its status from then, otherwise None. The
+        sha1 is taken from the dump or, if it has none, computed from text.
+        It's recorded when the page is collected, so it's written to the
+        same file as the article.'''
+        sha1 = ''.join(self.sha1_buffer).strip()
+        if not sha1:
+            sha1 = hashlib.sha1(text.encode('utf8')).hexdigest()
+        if self.previous is not None:
+            previous = self.previous.get(self.title)
+            if previous and previous[0] == sha1:
+                return sha1, previous[1]
+        return sha1, None
+    
+    def check_cache(self, text, status):
+        '''Looks the current page up in the cache. Returns its cache key,
+        if the result of processing it should be added to the cache, and
+        its (links, text) if found there.'''
+        if not self.cache or status:
+            return None, None
+        key = page_key(text)
+        cached = self.cache.get(key)
+        #Articles with too few links aren't cleaned, unless that has changed
+        if cached and (cached[1] is not None
+                       or len(cached[0]) < min_links_out):
+            return None, cached
+        return key, None
     
     def process(self):
         '''Process input buffer contents. This converts wikilanguage to
@@ -141,119 +509,402 @@ class WikiHandler(SAX.ContentHandler):
         
         #Ignore everything else if article redirects
         if self.redirect:
-            self.flush_input_buffer()
-            return None
-            global redirects
-            try:
-                redirects[self.title].add(self.redirect)
-            except KeyError:
-                redirects[self.title] = set([self.redirect])
+            self.add_redirect()
             self.flush_input_buffer()
             return None
         
         #Redirects handled - commence processing
-        print "processing: "+self.title.encode('utf8')
-        #Combine buffer content to a single string
-        text = ''.join(self.input_buffer).lower()
+        text = ''.join(self.input_buffer)
+        sha1, status = self.check_unchanged(text)
+        key, cached = self.check_cache(text, status)
+        self.collect(process_page(self.title, text, status, cached), key,
+                     sha1)
+        
+        #Done, flushing buffer
+        self.flush_input_buffer()
+        return None
+    
+    def add_redirect(self):
+        '''Registers the current page as a redirect. Titles are stored in
+        the same form as link targets, so links can be resolved later.
+        generate_indices.py converts page titles to that form as well.'''
+        source = link_extractor.canonical(self.title)
+        target = link_extractor.canonical(self.redirect)
+        if source and target and source != target:
+            self.redirects[source] = target
+    
+    def collect(self, result, key = None, sha1 = None):
+        '''Adds the result of processing a single page, as returned by
+        process_page, to the output buffer, linkhash and wordlist.
+        If key is given, the result is added to the cache under it, and if
+        sha1 is, it's recorded as the hash of the page.'''
+        title, links, text, article_words = result
+        print "processing: "+title.encode('utf8')
+        self.last_title = title
+        if key:
+            self.cache.put(key, links, text)
+        if sha1:
+            self.page_hashes[title] = sha1
         
-        #Find and process link information
-        link_regexp = re.compile(r'\[\[(.*?)\]')
-        links = re.findall(link_regexp, text)  #grap stuff like [[<something>]]
         #Add links to the parsers link hash
         for link in links:
-            #Check if link matches a namespace, e.g. 'file:something.png'
-            if any([ns+':' in link for ns in wikicleaner.namespaces]):
-                continue #Proceed to next link
-            #Namespaces done, so remove any colons:
-            link = link.replace(':', '')
-            if not link:
-                continue  #Some noob could've written an empty link...
-            #remove chapter designations/displaytext - keep article title
-            raw = re.match(r'([^\|\#]*)', link).group(0)
-            title = canonize_title(raw)
-            #note down that current article has outgoing link to 'title'
-            self.links.append(title)
-            #also note that 'title' has incoming link from here
+            #note that 'link' has incoming link from here
             try:
-                self.linkhash[title].add(self.title)  #maps target->sources
+                self.linkhash[link].add(title)  #maps target->sources
             except KeyError:
-                self.linkhash[title] = set([self.title])
+                self.linkhash[link] = set([title])
         
-        #Disregard current article if it contains too few links       
-        if len(self.links) < min_links_out:
-            self.flush_input_buffer()
-            return None
-        
-        #Cleanup text        
-        text = wikicleaner.clean(text)
-        article_words = text.split()
-        
-        #Disregard article if it contains too few words
-        if len(article_words) < min_words:
-            self.flush_input_buffer()
+        #Article was discarded due to too few links or words
+        if article_words is None:
             return None
-                
-        #Update global list of unique words
-        self.words.update(set(article_words))
         
         #Add content to output buffer
         output = {
             'text' : text,
             #Don't use category info for now
             #'categories' : self.categories,
-            'links_out' : self.links
+            'links_out' : links
         }
-        self.output_buffer[self.title] = output
+        
+        if text is False:
+            #Counted in the previous build
+            output['unchanged'] = True
+            del output['text']
+        elif shared.token_ids:
+            #Store word counts by id rather than the text
+            self.counts_buffer[title] = self.intern(article_words)
+            del output['text']
+        else:
+            #Count the article for each of its unique words
+            self.words.update(article_words)
+        
+        self.output_buffer[title] = output
         self.article_counter += 1
         
         #Flush output buffer to file
         if self.article_counter%1000 == 0:
-            self.writeout()            
-        
-        #Done, flushing buffer
-        self.flush_input_buffer()
+            self.writeout()
         return None
+    
+    def intern(self, counts):
+        '''Converts a Counter of words to arrays of word ids and counts.
+        Ids number the words of the current output file in order of
+        appearance, so they index the word file written along with it.'''
+        word_ids = self.word_ids
+        ids = [word_ids.setdefault(word, len(word_ids)) for word in counts]
+        return (np.array(ids, dtype = shared.index_dtype),
+                np.array(counts.values(), dtype = shared.index_dtype))
+    
+    def finish(self):
+        '''Called at EOF. Writes any remaining data to file.'''
+        self.writeout(done = True)
         
-    def writeout(self):
+    def writeout(self, done = False):
         '''Writes output buffer contents to file'''
         #Generate filename and write to file
-        filename = make_filename.next()
+        filename = self.make_filename.next()
         #Write article contents to file
         with open(filename+extensions['content'], 'w') as f:
             shared.dump(self.output_buffer, f)
         
         #Store wordlist as files
-        with open(filename+extensions['words'], 'w') as f:
-            shared.dump(self.words, f)
+        with open(filename+extensions['words'], 'wb') as f:
+            if shared.token_ids:
+                #Words in id order
+                ids = [ids for ids, counts in self.counts_buffer.itervalues()]
+                df = np.bincount(np.concatenate(ids or [[]]).astype(np.int64),
+                                 minlength = len(self.word_ids))
+                shared.dump_words(sorted(self.word_ids,
+                                         key = self.word_ids.get), df, f)
+            else:
+                shared.dump_words(self.words.keys(), self.words.values(), f)
+        
+        #Store word ids and counts
+        if shared.token_ids:
+            with open(filename+extensions['counts'], 'wb') as f:
+                shared.dump_counts(self.counts_buffer, f)
         
         #Store linkhash in files
-        with open(filename+extensions['links'], 'w') as f:
-            shared.dump(self.linkhash, f)
+        with open(filename+extensions['links'], 'wb') as f:
+            shared.dump_links(self.linkhash, f)
+        
+        #Store redirects and page hashes
+        with open(filename+extensions['redirects'], 'wb') as f:
+            shared.dump_redirects(self.redirects, f)
+        with open(filename+extensions['pages'], 'wb') as f:
+            shared.dump_pages(self.page_hashes, f)
+        if self.cache:
+            self.cache.flush()
         
         if self.verbose:
             log("wrote "+filename)
         
+        #Files are complete, so parsing can be resumed from here
+        self.files_written += 1
+        if self.checkpoint_file:
+            self.checkpoint(done)
+        
         #Empty output buffer
         self.flush_output_buffer()
         return None
     
+    def checkpoint(self, done = False):
+        '''Records how far parsing has come, so it can be resumed after the
+        last page written to file. The file is replaced atomically.'''
+        state = {'dump' : self.dump_name,
+                 'offset' : self.page_end,
+                 'title' : self.last_title,
+                 'files_written' : self.files_written,
+                 'articles' : self.article_counter,
+                 'done' : done}
+        temp_filename = self.checkpoint_file + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(state, f)
+        if os.name == 'nt' and os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)  #Windows can't rename over it
+        os.rename(temp_filename, self.checkpoint_file)
+
+class ExpatParser(object):
+    '''Faster alternative to the SAX parser. Feeds expat's callbacks
+    straight to the handler, skipping the SAX layer which wraps every event
+    and the attributes of every element in Python objects. Expat also buffers
+    character data, so the handler gets whole text nodes rather than a
+    callback for each line and entity.
+    Handlers only need startElement, endElement and characters, and attrs is
+    a plain dict, so a WikiHandler produces the same output as with SAX.'''
+    
+    buffer_size = 2**16  #Max characters pr. call to characters()
+    
+    def __init__(self):
+        self.handler = None
+        self.parser = None
+    
+    def setContentHandler(self, handler):
+        self.handler = handler
+    
+    def parse(self, source):
+        '''Parses a filename or file-like object.'''
+        parser = self.parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.buffer_size = self.buffer_size
+        parser.StartElementHandler = self.handler.startElement
+        parser.EndElementHandler = self.handler.endElement
+        parser.CharacterDataHandler = self.handler.characters
+        if isinstance(source, basestring):
+            with open(source, 'rb') as f:
+                parser.ParseFile(f)
+        else:
+            parser.ParseFile(source)
+
+def byte_index(parser):
+    '''Returns the position in bytes of the current event of a parser made
+    by make_parser, counted from the start of its input.'''
+    if isinstance(parser, ExpatParser):
+        return parser.parser.CurrentByteIndex
+    return parser._parser.CurrentByteIndex  #Expat parser inside SAX
+
+#Available XML parsers
+engines = {'sax' : SAX.make_parser,
+           'expat' : ExpatParser}
+
+def make_parser(engine = 'sax'):
+    '''Returns a new parser using the given engine (sax or expat).'''
+    return engines[engine]()
+
+class ParallelWikiHandler(WikiHandler):
+    '''ContentHandler which leaves the heavy lifting to a pool of worker
+    processes. The SAX parser only collects (title, text) pairs, which are
+    sent to the workers in batches. Results are collected in the order the
+    batches were sent, so output is identical to that of WikiHandler.'''
+    
+    def __init__(self, processes = None, batch_size = 100,
+                 filename_maker = None):
+        WikiHandler.__init__(self, filename_maker)
+        self.pool = multiprocessing.Pool(processes)
+        self.batch_size = batch_size
+        #Don't let the parser run too far ahead of the workers
+        self.max_pending = 2*(processes or multiprocessing.cpu_count())
+        self.batch = []
+        self.batch_ends = []  #Byte position after each page in the batch
+        self.batch_keys = []  #Cache key of each page in the batch
+        self.batch_hashes = []  #sha1 of each page in the batch
+        self.pending = deque()
+    
+    def process(self):
+        '''Adds the current page to the batch to be sent to the workers.'''
+        #Ignore everything else if article redirects. Redirects are
+        #recorded as they are parsed, so after resuming from a checkpoint
+        #some may be written twice, which does no harm.
+        if self.redirect:
+            self.add_redirect()
+            self.flush_input_buffer()
+            return None
+        
+        text = ''.join(self.input_buffer)
+        sha1, status = self.check_unchanged(text)
+        key, cached = self.check_cache(text, status)
+        #Cached articles are only split into words, so send no raw text
+        self.batch.append((self.title, None if cached else text, status,
+                           cached))
+        self.batch_ends.append(self.page_end)
+        self.batch_keys.append(key)
+        self.batch_hashes.append(sha1)
+        if len(self.batch) >= self.batch_size:
+            self.dispatch()
+        
+        self.flush_input_buffer()
+        return None
+    
+    def dispatch(self):
+        '''Sends the current batch to the pool and collects finished
+        results if too many batches are waiting.'''
+        if self.batch:
+            self.pending.append((self.pool.apply_async(process_batch,
+                                                       (self.batch,)),
+                                 self.batch_ends, self.batch_keys,
+                                 self.batch_hashes))
+            self.batch = []
+            self.batch_ends = []
+            self.batch_keys = []
+            self.batch_hashes = []
+        while len(self.pending) > self.max_pending:
+            self.collect_batch(*self.pending.popleft())
+    
+    def collect_batch(self, job, page_ends, keys, hashes):
+        '''Collects the results of a batch once it's done. Checkpoints
+        refer to the last page collected, not the last one parsed.'''
+        for result, page_end, key, sha1 in zip(job.get(), page_ends, keys,
+                                               hashes):
+            self.page_end = page_end
+            self.collect(result, key, sha1)
+    
+    def finish(self):
+        '''Waits for all batches to be processed before writing the
+        remaining data to file.'''
+        self.dispatch()
+        while self.pending:
+            self.collect_batch(*self.pending.popleft())
+        self.pool.close()
+        self.pool.join()
+        self.writeout(done = True)
+    
+def parse_multistream(filename, index_filename, n_shards, engine = 'sax',
+                      incremental = False):
+    '''Splits a multistream dump into shards using its index and parses
+    them in parallel, one WikiHandler per process. With incremental set,
+    articles unchanged since the previous build aren't cleaned again.'''
+    offsets = read_multistream_index(index_filename)
+    shards = make_shards(offsets, n_shards, os.path.getsize(filename))
+    log("Parsing %s in %s shards" % (filename, len(shards)))
+    #The shards share a run of the page cache
+    cache = open_cache()
+    run = cache and cache.run
+    if cache:
+        cache.close()
+    pool = multiprocessing.Pool(min(len(shards), multiprocessing.cpu_count()))
+    jobs = [(filename, n, start, end, engine, incremental, run)
+            for n, (start, end) in enumerate(shards)]
+    articles = sum(pool.map(parse_shard, jobs, chunksize = 1))
+    pool.close()
+    pool.join()
+    return articles
+
 if __name__ == "__main__":
-    if len(sys.argv) == 2:
-        file_to_parse = sys.argv[1]
-    else:
-        file_to_parse = DEFAULT_FILENAME
+    argparser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+    argparser.add_argument('dump', nargs = '?', default = DEFAULT_FILENAME,
+                           help = "Wikipedia XML dump, optionally .bz2/.gz")
+    argparser.add_argument('--index', help = "Index of a multistream dump. "
+                           "The dump is split into shards parsed in parallel.")
+    argparser.add_argument('--shards', type = int,
+                           default = multiprocessing.cpu_count(),
+                           help = "Number of shards for multistream dumps")
+    argparser.add_argument('--engine', choices = sorted(engines),
+                           default = 'sax', help = "XML parser to use")
+    argparser.add_argument('--resume', action = 'store_true',
+                           help = "Continue an interrupted parse from the "
+                           "last checkpoint")
+    argparser.add_argument('--incremental', action = 'store_true',
+                           help = "Update the previous build, only cleaning "
+                           "articles that changed since")
+    args = argparser.parse_args()
+    file_to_parse = args.dump
     
-    #Create and configure content handler
-    test = WikiHandler()
-    test.verbose = True
+    #Load checkpoint if resuming
+    state = None
+    if args.resume:
+        if args.index:
+            argparser.error("--resume doesn't work with multistream shards")
+        if os.path.exists(CHECKPOINT_FILE):
+            with open(CHECKPOINT_FILE, 'r') as f:
+                state = json.load(f)
+        if state and state['dump'] != os.path.abspath(file_to_parse):
+            argparser.error("Checkpoint is for %s" % state['dump'])
+        if state and state['done']:
+            log("Parsing of %s is already complete." % file_to_parse)
+            sys.exit()
+    if args.incremental and not os.path.exists(shared.pages_file):
+        argparser.error("No previous build to update in " + shared.matrix_dir)
     
-    #Create a parser and set handler
-    ATST = SAX.make_parser()
-    ATST.setContentHandler(test)
+    if state:
+        remove_uncommitted(state['files_written'])
+        log("Resuming after %s (byte %s)" % (state['title'].encode('utf8'),
+                                              state['offset']))
+    else:
+        cleanup()
+    
+    #Tell the following steps to update the previous build
+    if args.incremental:
+        if not os.path.exists(temp_dir):
+            os.makedirs(temp_dir)
+        with open(shared.update_file, 'w') as f:
+            shared.dump({'dump' : os.path.abspath(file_to_parse)}, f)
     
-    #Let the parser walk the file
     log("Parsing started...")
-    ATST.parse(file_to_parse)
+    if args.index:
+        parse_multistream(file_to_parse, args.index, args.shards,
+                          args.engine, args.incremental)
+    else:
+        #Create a parser
+        ATST = make_parser(args.engine)
+        
+        #Create and configure content handler
+        if state:
+            names = filename_generator(temp_dir,
+                                       count = state['files_written'])
+        else:
+            names = make_filename
+        if shared.parse_processes > 1:
+            test = ParallelWikiHandler(shared.parse_processes,
+                                       shared.parse_batch_size, names)
+        else:
+            test = WikiHandler(names)
+        test.verbose = True
+        if args.incremental:
+            test.previous = load_previous()
+        test.cache = open_cache()
+        
+        #Record progress in a checkpoint file at each write
+        test.checkpoint_file = CHECKPOINT_FILE
+        test.dump_name = os.path.abspath(file_to_parse)
+        if state:
+            dump = resume_dump(file_to_parse, state['offset'])
+            test.article_counter = state['articles']
+            test.files_written = state['files_written']
+            #The parser counts bytes from the start of what it's fed
+            start = state['offset'] - len('<mediawiki>')
+        else:
+            dump = open_dump(file_to_parse)
+            start = 0
+        test.locate = lambda: start + byte_index(ATST)
+        
+        #Let the parser walk the file
+        ATST.setContentHandler(test)
+        ATST.parse(dump)
+        dump.close()
+        if test.cache:
+            log("Page cache: %d hits, %d misses" % (test.cache.hits,
+                                                    test.cache.misses))
+            test.cache.close()
     log("...Parsing done!")
     
     #Attempt to send notification that job is done